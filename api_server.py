@@ -5,17 +5,23 @@ import shutil
 import sys
 import os
 import json
+import mimetypes
 import time
-from fastapi import FastAPI, Form, Request, File, UploadFile, WebSocket
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from fastapi import FastAPI, Form, Request, File, UploadFile, WebSocket, HTTPException
 from fastapi.websockets import WebSocketDisconnect
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 import requests
 import uvicorn
 from pydantic import BaseModel
-from typing import Union
+from typing import List, Union
+from cache import LRUCache
+from content_hash import image_hash
 from db_manager import DatabaseManager
 
-from utils import Utils
+from shards import ShardManager
+from utils import DEFAULT_PATHS, Utils
 
 
 def resource_path(relative_path):
@@ -33,6 +39,9 @@ app = FastAPI()
 
 config_path = resource_path('gui/config.json')
 config = json.loads(open(config_path, 'rb').read())
+# 旧版本的配置文件缺少新增的路径项，补上默认值后再转换路径，保存设置时一并写回
+for key, value in DEFAULT_PATHS.items():
+    config.setdefault(key, value)
 config_clone = config.copy()  # 备份以便于在写入文件中恢复相对路径
 paths_to_convert = [
     'web_path',
@@ -41,49 +50,44 @@ paths_to_convert = [
     'model_path',
     'exists_index_path',
     'metainfo_path',
+    'catalog_path',
+    'dedup_state_path',
+    'feature_store_path',
+    'shard_dir',
     'db_path',
     'ui']
 config.update({key: resource_path(config[key]) for key in paths_to_convert})
-utils = Utils(config)
+# sharded 为真时每个索引目录使用独立的索引分片
+utils = ShardManager(config) if config.get('sharded', False) else Utils(config)
+# 目录修改时间不可靠的文件系统（部分网络磁盘）可以用 --full 启动，每次都完整扫描
+full_rescan = '--full' in sys.argv
 
 db = DatabaseManager(config['db_path'])
 
+# 推理在有界的线程池中执行，下载和写文件在另一个线程池中执行，都不阻塞事件循环
+search_executor = ThreadPoolExecutor(max_workers=config.get('search_workers', 2))
+io_executor = ThreadPoolExecutor(max_workers=config.get('fetch_workers', 8))
+# 排队中的查询数量，只在事件循环线程中修改
+pending_searches = 0
+# 上传的查询图片只保存在内存中，按内容摘要索引，用于页面显示原图；添加记录时才写入磁盘
+UPLOAD_PREFIX = 'upload:'
+uploads = LRUCache(config.get('upload_cache_size', 32), config.get('upload_cache_ttl', 600),
+                   config.get('upload_cache_bytes', 256 * 1024 * 1024))
 
-def delete_old_files(directory):
-    """删除创建超过一定时间的缓存文件"""
-    # 获取当前时间
-    current_time = time.time()
-    # 设置阈值为10分钟
-    threshold = 600
 
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        # 获取文件的创建时间
-        creation_time = os.path.getctime(file_path)
-        # 计算文件的存在时间
-        age = current_time - creation_time
-        # 判断是否超过阈值
-        if age > threshold:
-            # 删除文件
-            os.remove(file_path)
-
-
-async def update_index():
+async def update_index(full=False):
     """更新索引"""
-    utils.remove_nonexists()
-    need_indexs = []
-    for image_dir in config['search_dir']:
-        need_index = utils.index_target_dir(image_dir)
-        need_indexs.extend(need_index)
-    nc = len(need_indexs)
-    if nc == 0:
-        await connection_manager.send_message('100')
-    for i, (idx, fpath) in enumerate(need_indexs):
-        utils.update_ir_index(idx, fpath)
-        progress = int((i + 1) / nc * 100)
+    loop = asyncio.get_running_loop()
+    updates = utils.update(config['search_dir'], full or full_rescan or None)
+    # 在线程池中推进生成器，等待 compact 释放维护锁以及提取特征时都不阻塞事件循环
+    while True:
+        step = await loop.run_in_executor(None, next, updates, None)
+        if step is None:
+            break
+        done, total = step
+        progress = int(done / total * 100) if total else 100
         await connection_manager.send_message(str(progress))
         await asyncio.sleep(0) # 插入一个小延迟，使得websocket能够正常发送消息
-    utils.exists_index = utils.get_exists_index()
 
 
 class ConnectionManager:
@@ -107,69 +111,139 @@ class ConnectionManager:
 connection_manager = ConnectionManager()
 
 
+@app.on_event("shutdown")
+def shutdown():
+    """退出前把增量日志合并进索引文件"""
+    search_executor.shutdown()
+    io_executor.shutdown()
+    utils.close()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     html_file = open(config['web_path'], 'r', encoding='utf-8').read()
-    if not os.path.exists(config['web_cache_path']):
-        # 检测缓存目录是否存在，不存在则创建
-        os.makedirs(config['web_cache_path'])
-    # 删除超过24小时的文件
-    delete_old_files(config['web_cache_path'])
     return html_file
 
 
+def fetch_url(url, max_bytes, timeout):
+    """下载网址文件，超过大小限制抛出 ValueError，超过总时长抛出 requests.Timeout"""
+    deadline = time.monotonic() + timeout
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > max_bytes:
+            raise ValueError(f'File larger than {max_bytes} bytes')
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f'File larger than {max_bytes} bytes')
+            if time.monotonic() > deadline:
+                raise requests.Timeout(f'Download took longer than {timeout} seconds')
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def write_file(path, data):
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def search_image(filename, image, ef, backend, folders):
+    """在推理线程池中执行的查询，image 为图片的 bytes，返回 (上传图片的路径, 结果)
+
+    摘要只在这里计算一次，同时用于保存上传图片和查询缓存。
+    """
+    digest = image_hash(image)
+    image_path = f"{UPLOAD_PREFIX}{digest}"
+    uploads.put(image_path, (filename, image), len(image))
+    nc = 20
+    index_count = utils.count()
+    nc = nc if nc <= index_count else index_count
+    results = utils.checkout(image, nc, ef, backend, folders, digest=digest)
+    results = sorted(results, key=lambda x: x[0], reverse=True)
+    results_dict = []
+    for i in results:
+        similarity = f'{i[0]:.2f} %'
+        path = i[1].replace('\\', '/')
+        name = path.split('/')[-1].split('.')[0]
+        results_dict.append({
+            "similarity": similarity,
+            "path": path,
+            "name": name
+        })
+    return image_path, results_dict
+
+
 @app.post("/uploadfile/")
 async def create_upload_file(
         file: UploadFile = File(None),
-        url: str = Form(None)):
-    """上传文件或下载网址文件"""
+        url: str = Form(None),
+        ef: int = Form(None),
+        backend: str = Form(None),
+        folders: List[str] = Form(None)):
+    """上传文件或下载网址文件，ef 可覆盖本次查询的候选列表大小，backend 可指定 hnsw 或 exact，
+    folders 可以限定只在这些目录中查找"""
+    global pending_searches
+    loop = asyncio.get_running_loop()
+    max_bytes = config.get('upload_max_bytes', 32 * 1024 * 1024)
+    timeout = config.get('fetch_timeout', 15)
     filename = ""
     if file is not None:
         # 如果是文件上传
         filename = f"image_{int(round(time.time() * 1000))}." + \
             file.filename.split(".")[-1]
-        with open(f"{config['web_cache_path']}/{filename}", "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        data = await file.read(max_bytes + 1)
     elif url is not None:
-        # 如果是网址下载文件
+        # 如果是网址下载文件，在线程池中下载，同时限制大小和总时长
         filename = f"image_{int(round(time.time() * 1000))}." + \
             url.split("/")[-1].split(".")[-1]  # 从网址中提取文件名
-        response = requests.get(url, stream=True)
-        with open(f"{config['web_cache_path']}/{filename}", "wb") as f:
-            shutil.copyfileobj(response.raw, f)
+        try:
+            data = await asyncio.wait_for(
+                loop.run_in_executor(io_executor, fetch_url, url, max_bytes, timeout), timeout)
+        except (asyncio.TimeoutError, requests.Timeout):
+            raise HTTPException(status_code=504, detail="Download timed out")
+        except ValueError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except requests.RequestException as e:
+            raise HTTPException(status_code=502, detail=f"Download failed: {e}")
     else:
         return {"message": "No file or url provided"}
-
-    nc = 20
-    exists_index = utils.get_exists_index()  # 加载索引
-    nc = nc if nc <= len(exists_index) else len(exists_index)
-    results = utils.checkout(
-        f"{config['web_cache_path']}/{filename}",
-        exists_index,
-        nc)
-    results = sorted(results, key=lambda x: x[0], reverse=True)
-    results_dict = []
-    for i in results:
-        similarity = f'{i[0]:.2f} %'
-        path = i[1].replace('\\', '/')
-        name = path.split('/')[-1].split('.')[0]
-        results_dict.append({
-            "similarity": similarity,
-            "path": path,
-            "name": name
-        })
-    # results_dict = sorted(results_dict, key=lambda x: x['similarity'], reverse=True)
+    if len(data) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File larger than {max_bytes} bytes")
+    # 排队的查询过多时直接拒绝，避免请求无限堆积，被拒绝的图片也不占用上传缓存
+    if pending_searches >= config.get('search_max_pending', 32):
+        raise HTTPException(status_code=503, detail="Too many pending searches")
+    pending_searches += 1
+    try:
+        # 不落盘，直接在内存中解码查询
+        image_path, results_dict = await loop.run_in_executor(
+            search_executor, partial(search_image, filename, data, ef, backend, folders))
+    finally:
+        pending_searches -= 1
 
     return {
         "original_file": {
             "name": filename,
-            "path": f"{config['web_cache_path']}/{filename}".encode('utf-8')},
+            "path": image_path.encode('utf-8')},
         "results": results_dict}
 
 
+def get_upload(image_path):
+    """取回内存中的上传图片 (文件名, 数据)，已过期时返回 404"""
+    upload = uploads.get(image_path)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Uploaded image expired, please search again")
+    return upload
+
+
 @app.get("/image/")
 async def get_image(image_path: str):
-    """获取图片"""
+    """获取图片，上传的查询图片从内存中返回"""
+    if image_path.startswith(UPLOAD_PREFIX):
+        filename, data = get_upload(image_path)
+        return Response(content=data, media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
     return FileResponse(image_path)
 
 
@@ -209,12 +283,7 @@ async def addRecord(rf: RecordForm):
         db.update_data(
             'path', f'title="{rf.record}",path="{new_path}"', f'id={rf.path_id}')
         os.rename(old_path, new_path)
-        with open(config["exists_index_path"], 'r', encoding='utf-8') as f:
-            index_list = json.loads(f.read())
-        index_list = list(map(lambda file: file.replace(old_path, new_path), index_list))
-        with open(config["exists_index_path"], 'wb') as f:
-            f.write(json.dumps(index_list, indent=2,
-                     ensure_ascii=False).encode('UTF-8'))
+        utils.rename(old_path, new_path)  # 原地更新路径，特征无需重新提取
         await update_index()
         return {"code": 200, "message": "Record updated successfully", "id": {"resource_id": rf.resource_id, "path_id": rf.path_id}}
     # 将不允许的字符替换为中文字符
@@ -242,7 +311,12 @@ async def addRecord(rf: RecordForm):
         new_filename = f"{cleaned_record}（{index}）{ext}"
         new_path = os.path.join(config["record_path"], new_filename)
         index += 1
-    shutil.move(rf.image_path, new_path)
+    if rf.image_path.startswith(UPLOAD_PREFIX):
+        # 上传的查询图片此时才写入磁盘
+        _, data = get_upload(rf.image_path)
+        await asyncio.get_running_loop().run_in_executor(io_executor, write_file, new_path, data)
+    else:
+        shutil.move(rf.image_path, new_path)
 
     await update_index()
 
@@ -269,11 +343,45 @@ async def websocket_endpoint(websocket: WebSocket, client_id: int):
 
 
 @app.get("/updateIndex/")
-async def updateIndex():
-    """更新索引"""
-    await update_index()
+async def updateIndex(full: bool = False):
+    """更新索引，full=true 时完整扫描所有文件"""
+    await update_index(full)
     return {"code": 200, "message": "Index updated successfully"}
 
+@app.get("/compact/")
+def compact(force: bool = False):
+    """已删除的图片超过配置的比例时重建紧凑的目录和索引，force=true 时总是重建"""
+    report = utils.compact(force)
+    return {"code": 200, "report": report}
+
+@app.get("/rebuildIndex/")
+def rebuildIndex():
+    """由特征文件重建 HNSW 索引，修改 M、ef_construction 后使用，不需要重新提取特征"""
+    count = utils.rebuild_index()
+    return {"code": 200, "message": f"Index rebuilt with {count} items"}
+
+@app.get("/fitProjection/")
+def fitProjection(n_components: int = 256, whiten: bool = False):
+    """抽样拟合 PCA 投影并在降维后的向量上重建索引，n_components=0 时恢复原始维度"""
+    explained = utils.fit_projection(n_components, whiten)
+    return {"code": 200, "message": f"Index rebuilt with {n_components or 'full'} dimensions", "explained": explained}
+
+@app.get("/duplicateGroups/")
+def duplicateGroups(threshold: float = 90, same_folder: bool = False, incremental: bool = False):
+    """查找重复图片并按组返回，incremental=true 时只检查上次之后新增或修改的图片
+
+    耗时较长，使用普通函数让 FastAPI 放到线程池中执行
+    """
+    groups = utils.get_duplicate_groups(threshold, same_folder, incremental)
+    return {"code": 200, "groups": groups}
+
+
+@app.get("/stats/")
+def stats():
+    """检索的运行统计，包括合并查询的批大小分布和查询缓存的命中次数"""
+    return {"code": 200, "stats": utils.stats()}
+
+
 @app.get("/getRecordInfo/")
 async def getRecordInfo(record: str):
     """获取记录信息"""
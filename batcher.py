@@ -0,0 +1,108 @@
+import time
+import queue
+import threading
+import numpy as np
+from collections import Counter
+from concurrent.futures import Future
+
+
+class QueryBatcher:
+    """把并发到达的查询合并成批
+
+    第一条查询到达后最多再等待 max_wait_ms 毫秒，收集至多 max_batch 条，一次批量推理，
+    再按 (ef, 检索后端) 分组各做一次多行 knn_query，取组内最大的 k，每个调用方取回自己的一行并截断到自己的 k。
+    已缓存特征向量的查询直接带上向量提交，跳过推理，仍参与 knn_query 的合并。
+    记录每批的实际大小，用于确认合并是否生效。
+    """
+
+    def __init__(self, ir_engine, max_batch=8, max_wait_ms=5):
+        self.ir_engine = ir_engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_path, k=None, ef=None, backend=None, fv=None):
+        """k 为 None 时只提取特征，结果为特征向量；否则结果为 (labels, distances, 特征向量)；图片无法解码时结果为 None
+
+        fv 不为 None 时不再推理，直接用它查询。
+        """
+        future = Future()
+        self.requests.put((image_path, k, ef, backend, future, fv))
+        return future
+
+    def query(self, image_path, k, ef=None, backend=None, fv=None):
+        return self.submit(image_path, k, ef, backend, fv).result()
+
+    def embed(self, image_path):
+        return self.submit(image_path).result()
+
+    def run(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # 先处理完已收集的查询再退出
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+            self.process(batch)
+
+    def process(self, batch):
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+        try:
+            vectors = {i: item[5] for i, item in enumerate(batch) if item[5] is not None}
+            pending = [i for i in range(len(batch)) if i not in vectors]
+            if pending:
+                fvs, valid = self.ir_engine.get_fv_batch([batch[i][0] for i in pending])
+                vectors.update((pending[v], fvs[row]) for row, v in enumerate(valid))
+            groups = {}
+            for i, (_, k, ef, backend, future, _) in enumerate(batch):
+                if i not in vectors:
+                    future.set_result(None)
+                elif k is None:
+                    future.set_result(vectors[i])
+                else:
+                    groups.setdefault((ef, backend), []).append(i)
+            for (ef, backend), members in groups.items():
+                k = max(batch[i][1] for i in members)
+                labels, distances = self.ir_engine.knn_query(
+                    np.stack([vectors[i] for i in members]), k, ef, backend=backend)
+                for row, i in enumerate(members):
+                    k = batch[i][1]
+                    batch[i][4].set_result((labels[row][:k], distances[row][:k], vectors[i]))
+        except Exception as e:
+            for item in batch:
+                if not item[4].done():
+                    item[4].set_exception(e)
+
+    def stats(self):
+        with self.lock:
+            sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        queries = sum(size * count for size, count in sizes.items())
+        return {
+            'batches': batches,
+            'queries': queries,
+            'mean_batch_size': queries / batches if batches else 0,
+            'batch_sizes': {str(size): sizes[size] for size in sorted(sizes)},
+        }
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
@@ -0,0 +1,466 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from efficient_ir import EfficientIR
+
+
+ACCEPTED_EXTS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif', '.webp')
+
+
+def load_config(config_path):
+    config = json.loads(open(config_path, 'rb').read())
+    base_path = os.path.dirname(os.path.dirname(os.path.abspath(config_path)))
+    for key in ['index_path', 'model_path', 'exists_index_path', 'metainfo_path', 'catalog_path',
+                'dedup_state_path', 'feature_store_path', 'shard_dir']:
+        config[key] = os.path.join(base_path, config[key])
+    return config
+
+
+def list_images(image_dir, limit):
+    image_paths = []
+    for root, dirs, files in os.walk(image_dir):
+        for name in files:
+            if name.lower().endswith(ACCEPTED_EXTS):
+                image_paths.append(os.path.join(root, name))
+                if len(image_paths) >= limit:
+                    return image_paths
+    return image_paths
+
+
+def model_only_engine(config):
+    """只加载模型的引擎，索引放在临时目录，不会改动现有索引"""
+    index_path = os.path.join(tempfile.mkdtemp(), 'index.bin')
+    return EfficientIR(
+        config['img_size'], 1, index_path, config['model_path'],
+        config.get('fast_decode', True), config.get('max_decode_pixels'),
+    )
+
+
+def bench_batch(args, config):
+    """不同批大小下的推理吞吐量（图片/秒）"""
+    engine = model_only_engine(config)
+    image_paths = list_images(args.image_dir, args.count)
+    if not image_paths:
+        sys.exit(f'No images found in {args.image_dir}')
+    # 预热，避免首次推理的初始化开销影响结果
+    engine.get_fv_batch(image_paths[:1])
+    print(f'{"batch":>6} {"images":>7} {"seconds":>8} {"img/s":>8}')
+    for batch_size in [1, 2, 4, 8, 16, 32, 64]:
+        start = time.perf_counter()
+        done = 0
+        for i in range(0, len(image_paths), batch_size):
+            fvs, valid = engine.get_fv_batch(image_paths[i:i+batch_size])
+            done += len(valid)
+        elapsed = time.perf_counter() - start
+        print(f'{batch_size:>6} {done:>7} {elapsed:>8.2f} {done/elapsed:>8.1f}')
+
+
+def legacy_img_preprocess(image_path, img_size):
+    """优化前的 img_preprocess 实现，作为正确性与性能的对照"""
+    try:
+        img = Image.open(image_path).resize((img_size, img_size),Image.BICUBIC)
+        img = img.convert('RGBA').convert('RGB')
+    except OSError:
+        return None
+    input_data = np.array(img).transpose(2, 0, 1)
+    img_data = input_data.astype('float32')
+    mean_vec = np.array([0.485, 0.456, 0.406])
+    stddev_vec = np.array([0.229, 0.224, 0.225])
+    norm_img_data = np.zeros(img_data.shape).astype('float32')
+    for i in range(img_data.shape[0]):
+        norm_img_data[i,:,:] = (img_data[i,:,:]/255 - mean_vec[i]) / stddev_vec[i]
+    norm_img_data = norm_img_data.reshape(1, 3, img_size, img_size).astype('float32')
+    return norm_img_data
+
+
+def bench_preprocess(args, config):
+    """新旧预处理的输出一致性与耗时对比"""
+    engine = model_only_engine(config)
+    # 旧实现按原分辨率解码，对比时同样关闭缩小解码
+    engine.fast_decode = False
+    img_size = config['img_size']
+    image_paths = list_images(args.image_dir, args.count)
+    if not image_paths:
+        sys.exit(f'No images found in {args.image_dir}')
+    # 只比较归一化部分，图片提前解码好避免解码耗时掩盖差异
+    images = [engine.load_image(path) for path in image_paths]
+    images = [img for img in images if img is not None]
+
+    max_diff = 0.0
+    slot = np.empty((3, img_size, img_size), dtype='float32')
+    for path in image_paths:
+        expected = legacy_img_preprocess(path, img_size)
+        actual = engine.img_preprocess(path, slot)
+        if expected is None or actual is None:
+            continue
+        max_diff = max(max_diff, float(np.abs(expected[0] - actual).max()))
+    print(f'max abs diff: {max_diff:.2e} ({"OK" if max_diff < 1e-5 else "MISMATCH"})')
+
+    def legacy_normalize(img):
+        img = img.convert('RGBA').convert('RGB')
+        img_data = np.array(img).transpose(2, 0, 1).astype('float32')
+        mean_vec = np.array([0.485, 0.456, 0.406])
+        stddev_vec = np.array([0.229, 0.224, 0.225])
+        norm_img_data = np.zeros(img_data.shape).astype('float32')
+        for i in range(img_data.shape[0]):
+            norm_img_data[i,:,:] = (img_data[i,:,:]/255 - mean_vec[i]) / stddev_vec[i]
+        return norm_img_data.reshape(1, 3, img_size, img_size).astype('float32')
+
+    for name, func in [('legacy', legacy_normalize),
+                       ('vectorised', lambda img: engine.normalize_into(img, slot))]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for img in images:
+                func(img)
+        elapsed = time.perf_counter() - start
+        per_image = elapsed / (len(images) * args.repeat) * 1e6
+        print(f'{name:>10}: {per_image:.1f} us/image')
+
+
+def bench_decode(args, config):
+    """缩小解码（draft/reduce）与完整解码的耗时对比"""
+    engine = model_only_engine(config)
+    image_paths = list_images(args.image_dir, args.count)
+    if not image_paths:
+        sys.exit(f'No images found in {args.image_dir}')
+    for fast_decode in [False, True]:
+        engine.fast_decode = fast_decode
+        start = time.perf_counter()
+        decoded = sum(engine.load_image(path) is not None for path in image_paths)
+        elapsed = time.perf_counter() - start
+        print(f'fast_decode={fast_decode!s:>5}: {decoded} images, {elapsed/max(decoded, 1)*1000:.1f} ms/image')
+
+
+def legacy_get_duplicate(ir_engine, exists_index, threshold, same_folder):
+    """优化前逐条 get_items + knn_query 的查重实现，作为对照
+
+    直接查询 HNSW 索引，不经过 knn_query 的后端选择和重排序，保持旧版的行为。
+    """
+    def match(fv, k):
+        labels, distances = ir_engine.hnsw_knn_query(fv, k)
+        return ir_engine.similarity(distances[0]), labels[0]
+
+    # k 不能超过索引中未删除的条目数，所有条目都高于阈值时不再扩大
+    live = ir_engine.feature_store.count()
+    matched = set()
+    for idx in exists_index:
+        match_n = min(5, live)
+        try:
+            fv = ir_engine.hnsw_index.get_items([idx])[0]
+        except RuntimeError:
+            continue
+        sim, ids = match(fv, match_n)
+        while sim[-1] > threshold and match_n < live:
+            match_n = min(round(match_n*1.5), live)
+            sim, ids = match(fv, match_n)
+        for i in range(len(ids)):
+            if ids[i] == idx:
+                continue
+            if sim[i] < threshold:
+                continue
+            if ids[i] in matched:
+                continue
+            if ids[i] not in exists_index:
+                continue
+            if not idx in matched:
+                matched.add(idx)
+            path_a = exists_index[idx]
+            path_b = exists_index[ids[i]]
+            if same_folder:
+                if os.path.dirname(path_a) != os.path.dirname(path_b):
+                    continue
+            yield (path_a, path_b, sim[i])
+
+
+def bench_dedup(args, config):
+    """批量查重与旧版逐条查重的吞吐量对比，使用现有索引
+
+    两边都直接查询 HNSW 索引；默认配置在条目较少时会改用暴力检索，相似度略有差异，不能用来比较结果。
+    """
+    from dedup import DedupEngine
+    from utils import Utils
+    utils = Utils(config)
+    dedup_engine = DedupEngine(utils.ir_engine, utils.dedup_engine.block_size, utils.dedup_engine.num_threads, backend='hnsw')
+    exists_index = dict(utils.catalog.items())
+    if args.limit:
+        exists_index = dict(list(exists_index.items())[:args.limit])
+    results = {}
+    for name, pairs in [
+            ('legacy', lambda: legacy_get_duplicate(utils.ir_engine, exists_index, args.threshold, False)),
+            ('batched', lambda: dedup_engine.find_pairs(exists_index, args.threshold, False))]:
+        start = time.perf_counter()
+        results[name] = [(a, b, round(float(sim), 4)) for a, b, sim in pairs()]
+        elapsed = time.perf_counter() - start
+        print(f'{name:>8} (hnsw): {len(results[name])} pairs, {len(exists_index)/elapsed:.1f} queries/s')
+    print('same pairs' if results['legacy'] == results['batched'] else 'PAIRS DIFFER')
+
+
+def bench_tune(args, config):
+    """抽样计算精确近邻，给出 ef 的召回率/延迟曲线并选出满足目标召回率的最小 ef"""
+    from utils import Utils
+    from tuner import tune_ef
+    utils = Utils(config)
+    ids = [idx for idx, _ in utils.catalog.items()]
+    chosen, curve = tune_ef(utils.ir_engine, ids, args.k, args.sample, args.target)
+    print(f'{"ef":>6} {"recall@" + str(args.k):>10} {"ms/query":>9}')
+    for ef, recall, latency in curve:
+        print(f'{ef:>6} {recall:>10.4f} {latency:>9.3f}')
+    print(f'smallest ef reaching recall {args.target}: {chosen}')
+    if args.write:
+        saved = json.loads(open(args.config, 'rb').read())
+        saved['ef'] = chosen
+        with open(args.config, 'wb') as wp:
+            wp.write(json.dumps(saved, indent=2, ensure_ascii=False).encode('UTF-8'))
+        print(f'ef written to {args.config}')
+
+
+def bench_exact(args, config):
+    """精确暴力检索与 HNSW 的单条查询延迟、批量吞吐量对比，以及 HNSW 与重排的召回率"""
+    from utils import Utils
+    utils = Utils(config)
+    engine = utils.ir_engine
+    ids = [idx for idx, _ in utils.catalog.items()]
+    rng = np.random.default_rng(0)
+    queries, _ = engine.get_fvs(rng.choice(ids, size=min(args.sample, len(ids)), replace=False))
+    k = min(args.k, len(ids))
+    # 预热，精确检索首次调用时计算库向量的范数
+    truth = engine.exact_search.search(queries, k)[0]
+    runs = [('exact', lambda q: engine.exact_search.search(q, k)),
+            ('hnsw', lambda q: engine.hnsw_knn_query(q, k))]
+    if args.rerank > k:
+        runs.append((f'hnsw+rerank{args.rerank}',
+                     lambda q: engine.exact_search.rerank(q, engine.hnsw_knn_query(q, args.rerank)[0], k)))
+    print(f'{len(ids)} items, {len(queries)} queries, k={k}')
+    print(f'{"backend":>16} {"ms/query":>9} {"batch q/s":>10} {"recall@" + str(k):>10}')
+    for name, query in runs:
+        start = time.perf_counter()
+        labels = np.vstack([query(queries[i:i+1])[0] for i in range(len(queries))])
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        start = time.perf_counter()
+        query(queries)
+        throughput = len(queries) / (time.perf_counter() - start)
+        recall = np.mean([len(set(labels[i]) & set(truth[i])) / k for i in range(len(queries))])
+        print(f'{name:>16} {latency:>9.3f} {throughput:>10.1f} {recall:>10.4f}')
+
+
+def bench_quantize(args, config):
+    """float32/float16/int8 暴力检索的内存占用、延迟与召回率，并与现有 float32 HNSW 索引对比"""
+    from utils import Utils
+    from exact_search import ExactSearch
+    utils = Utils(config)
+    engine = utils.ir_engine
+    ids = [idx for idx, _ in utils.catalog.items()]
+    rng = np.random.default_rng(0)
+    queries, _ = engine.get_fvs(rng.choice(ids, size=min(args.sample, len(ids)), replace=False))
+    k = min(args.k, len(ids))
+    truth = ExactSearch(engine.feature_store).search(queries, k)[0]
+
+    def measure(query):
+        start = time.perf_counter()
+        labels = np.vstack([query(queries[i:i+1])[0] for i in range(len(queries))])
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(labels[i]) & set(truth[i])) / k for i in range(len(queries))])
+        return latency, recall
+
+    print(f'{len(ids)} items, {len(queries)} queries, k={k}, rerank {args.rerank} candidates')
+    print(f'{"tier":>10} {"MB":>9} {"ms/query":>9} {"recall@" + str(k):>10} {"no rerank":>10}')
+    for dtype in ['float32', 'float16', 'int8']:
+        search = ExactSearch(engine.feature_store, dtype=dtype, rerank_k=args.rerank)
+        size = search.nbytes() / 2**20
+        latency, recall = measure(lambda q: search.search(q, k))
+        _, raw_recall = measure(lambda q: search.scan(q, k))
+        print(f'{dtype:>10} {size:>9.1f} {latency:>9.3f} {recall:>10.4f} {raw_recall:>10.4f}')
+    # hnswlib 按容量预分配：每个元素的 float32 向量、第 0 层 2M 条边和标签
+    hnsw_size = engine.nbytes()[0] / 2**20
+    latency, recall = measure(lambda q: engine.hnsw_knn_query(q, k))
+    print(f'{"hnsw":>10} {hnsw_size:>9.1f} {latency:>9.3f} {recall:>10.4f} {"":>10}')
+
+
+def bench_pca(args, config):
+    """原始维度与降维后的 HNSW 索引在构建耗时、查询延迟、内存与召回率上的对比
+
+    召回率相对原始 1000 维的精确近邻，索引建在内存中，不改动现有索引。
+    """
+    import hnswlib
+    from utils import Utils
+    from projection import Projection
+    utils = Utils(config)
+    engine = utils.ir_engine
+    store = engine.feature_store
+    ids = store.valid_ids()[:args.limit]
+    data = np.asarray(store.data[ids])
+    rng = np.random.default_rng(0)
+    queries = data[rng.choice(len(ids), size=min(args.sample, len(ids)), replace=False)]
+    k = min(args.k, len(ids))
+    dist = np.einsum('ij,ij->i', queries, queries)[:, None] - 2 * queries @ data.T + np.einsum('ij,ij->i', data, data)[None, :]
+    truth = ids[np.argpartition(dist, k - 1, axis=1)[:, :k]]
+    fit_rows = rng.choice(len(ids), size=min(args.fit_sample, len(ids)), replace=False)
+    print(f'{len(ids)} items, {len(queries)} queries, k={k}')
+    print(f'{"dim":>6} {"explained":>9} {"build s":>8} {"MB":>8} {"ms/query":>9} {"recall@" + str(k):>10}')
+    for dim in [0] + args.dims:
+        projection = None
+        if dim:
+            projection = Projection.fit(data[fit_rows], dim, args.whiten)
+        vectors = projection.apply(data) if projection else data
+        index = hnswlib.Index(space='l2', dim=vectors.shape[1])
+        index.init_index(max_elements=len(ids), ef_construction=engine.ef_construction, M=engine.M)
+        start = time.perf_counter()
+        index.add_items(vectors, ids)
+        build = time.perf_counter() - start
+        index.set_ef(engine.ef)
+        projected = projection.apply(queries) if projection else queries
+        start = time.perf_counter()
+        labels = np.vstack([index.knn_query(projected[i:i+1], k=k, num_threads=1)[0] for i in range(len(queries))])
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(labels[i]) & set(truth[i])) / k for i in range(len(queries))])
+        size = len(ids) * (vectors.shape[1] * 4 + engine.M * 2 * 4 + 4 + 8) / 2**20
+        explained = projection.explained if projection else 1.0
+        print(f'{dim or engine.feature_dim:>6} {explained:>9.4f} {build:>8.2f} {size:>8.1f} {latency:>9.3f} {recall:>10.4f}')
+
+
+def bench_load(args, config):
+    """/uploadfile/ 的并发压测，统计吞吐量与延迟分位数
+
+    本地起一个 HTTP 服务充当图片网址的来源，--delay 模拟远端服务器的响应延迟。
+    对改动前后的 api_server 各运行一次即可对比。服务端会缓存特征和查询结果，每次压测前重启服务；
+    --count 不小于 --requests 时每个请求的图片都不同，测的是不命中缓存的情况。
+    """
+    import functools
+    import threading
+    import urllib.parse
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    image_paths = list_images(args.image_dir, args.count)
+    if not image_paths:
+        sys.exit(f'No images found in {args.image_dir}')
+    delay = args.delay / 1000
+
+    class SlowHandler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(SlowHandler, directory=args.image_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    def request(i):
+        image_path = image_paths[i % len(image_paths)]
+        if args.mode == 'url':
+            rel_path = os.path.relpath(image_path, args.image_dir).replace(os.sep, '/')
+            body = urllib.parse.urlencode({'url': base_url + urllib.parse.quote(rel_path)}).encode()
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        else:
+            boundary = 'efficientir-load-test'
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                    f'filename="image{os.path.splitext(image_path)[1]}"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n').encode()
+            body += open(image_path, 'rb').read() + f'\r\n--{boundary}--\r\n'.encode()
+            headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        start = time.perf_counter()
+        try:
+            req = urllib.request.Request(args.server.rstrip('/') + '/uploadfile/', body, headers)
+            with urllib.request.urlopen(req, timeout=args.timeout) as response:
+                response.read()
+            ok = True
+        except OSError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    latencies = np.array([latency for latency, ok in results if ok]) * 1000
+    errors = sum(not ok for _, ok in results)
+    print(f'{args.requests} requests, concurrency {args.concurrency}, mode {args.mode}, source delay {args.delay} ms')
+    print(f'throughput {len(latencies)/elapsed:.2f} req/s, errors {errors}')
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f'latency ms: p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f}  max {latencies.max():.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EfficientIR 性能测试')
+    parser.add_argument('--config', default='gui/config.json')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = subparsers.add_parser('batch', help='批量推理吞吐量')
+    batch_parser.add_argument('image_dir')
+    batch_parser.add_argument('--count', type=int, default=256)
+    batch_parser.set_defaults(func=bench_batch)
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='预处理正确性与耗时')
+    preprocess_parser.add_argument('image_dir')
+    preprocess_parser.add_argument('--count', type=int, default=64)
+    preprocess_parser.add_argument('--repeat', type=int, default=10)
+    preprocess_parser.set_defaults(func=bench_preprocess)
+
+    decode_parser = subparsers.add_parser('decode', help='缩小解码耗时')
+    decode_parser.add_argument('image_dir')
+    decode_parser.add_argument('--count', type=int, default=64)
+    decode_parser.set_defaults(func=bench_decode)
+
+    dedup_parser = subparsers.add_parser('dedup', help='查重吞吐量')
+    dedup_parser.add_argument('--threshold', type=float, default=90)
+    dedup_parser.add_argument('--limit', type=int, default=10000)
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    tune_parser = subparsers.add_parser('tune', help='调整查询时的 ef')
+    tune_parser.add_argument('--k', type=int, default=20)
+    tune_parser.add_argument('--sample', type=int, default=500)
+    tune_parser.add_argument('--target', type=float, default=0.95)
+    tune_parser.add_argument('--write', action='store_true', help='把选出的 ef 写入配置文件')
+    tune_parser.set_defaults(func=bench_tune)
+
+    exact_parser = subparsers.add_parser('exact', help='精确检索与 HNSW 对比')
+    exact_parser.add_argument('--k', type=int, default=20)
+    exact_parser.add_argument('--sample', type=int, default=500)
+    exact_parser.add_argument('--rerank', type=int, default=100, help='重排时从 HNSW 取的候选数')
+    exact_parser.set_defaults(func=bench_exact)
+
+    quantize_parser = subparsers.add_parser('quantize', help='压缩检索的内存、延迟与召回率')
+    quantize_parser.add_argument('--k', type=int, default=20)
+    quantize_parser.add_argument('--sample', type=int, default=500)
+    quantize_parser.add_argument('--rerank', type=int, default=100, help='压缩扫描后重排的候选数')
+    quantize_parser.set_defaults(func=bench_quantize)
+
+    pca_parser = subparsers.add_parser('pca', help='降维索引的速度与召回率')
+    pca_parser.add_argument('--dims', type=int, nargs='+', default=[256, 128])
+    pca_parser.add_argument('--whiten', action='store_true')
+    pca_parser.add_argument('--k', type=int, default=20)
+    pca_parser.add_argument('--sample', type=int, default=500)
+    pca_parser.add_argument('--fit-sample', type=int, default=20000)
+    pca_parser.add_argument('--limit', type=int, default=100000)
+    pca_parser.set_defaults(func=bench_pca)
+
+    load_parser = subparsers.add_parser('load', help='/uploadfile/ 并发压测')
+    load_parser.add_argument('image_dir')
+    load_parser.add_argument('--server', default='http://127.0.0.1:5555')
+    load_parser.add_argument('--mode', choices=['url', 'file'], default='url')
+    load_parser.add_argument('--requests', type=int, default=200)
+    load_parser.add_argument('--concurrency', type=int, default=16)
+    load_parser.add_argument('--delay', type=float, default=200, help='图片服务器的响应延迟（毫秒）')
+    load_parser.add_argument('--count', type=int, default=64)
+    load_parser.add_argument('--timeout', type=float, default=120)
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args, load_config(args.config))
+
+
+if __name__ == '__main__':
+    main()
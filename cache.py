@@ -0,0 +1,76 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """同时按条目数、总字节数和存活时间淘汰的 LRU 缓存，线程安全
+
+    超过 max_items 或条目的 nbytes 之和超过 max_bytes 时淘汰最久未使用的条目，max_bytes 为 0 时不限字节数；
+    条目写入超过 ttl 秒后视为失效，ttl 为 0 时不按时间淘汰。记录命中和未命中次数。
+    """
+
+    def __init__(self, max_items=256, ttl=600, max_bytes=0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, item, now):
+        return self.ttl and now - item[0] > self.ttl
+
+    def _pop(self, key):
+        self.nbytes -= self.items.pop(key)[2]
+
+    def get(self, key):
+        """未命中或已过期时返回 None"""
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and self._expired(item, time.monotonic()):
+                self._pop(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, nbytes=0):
+        """nbytes 为条目计入 max_bytes 的大小，单个条目超过 max_bytes 时不缓存"""
+        if self.max_items <= 0 or (self.max_bytes and nbytes > self.max_bytes):
+            return
+        with self.lock:
+            now = time.monotonic()
+            if key in self.items:
+                self._pop(key)
+            self.items[key] = (now, value, nbytes)
+            self.nbytes += nbytes
+            while len(self.items) > self.max_items or (self.max_bytes and self.nbytes > self.max_bytes):
+                self.nbytes -= self.items.popitem(last=False)[1][2]
+            # 顺带清掉排在最前面的过期条目，过期的大条目不必等到容量用尽才释放
+            while self.items:
+                oldest = next(iter(self.items))
+                if not self._expired(self.items[oldest], now):
+                    break
+                self._pop(oldest)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0,
+            }
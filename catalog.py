@@ -0,0 +1,287 @@
+import os
+import json
+import sqlite3
+import threading
+
+
+class Catalog:
+    """文件目录：记录索引 id 与文件路径、大小、修改时间的对应关系
+
+    使用 WAL 模式的 SQLite，path 上建唯一索引，id 为主键，两个方向的查询都是 O(1)。
+    已删除的文件保留 id 作为墓碑，path 置空，与 HNSW 中被标记删除的节点一一对应。新文件优先复用墓碑的 id，
+    HNSW 中同一标签的节点被原地更新，不再增长；墓碑过多时用 compact 重新编号。
+    dirs 表记录每个目录的修改时间和文件数，用于增量扫描。hash 列为文件内容摘要，用于查找完全相同的文件。
+    seq 列为单调递增的变更序号，写入新增或修改的文件以及特征写入索引时递增，用于增量查重。
+    meta 表的 epoch 为 compact 的次数，与索引元数据中的 epoch 对照，用于发现中途退出的 compact。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_table()
+
+    def create_table(self):
+        """创建表"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT,
+                    size INTEGER,
+                    mtime REAL,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    dir TEXT,
+                    hash TEXT,
+                    seq INTEGER NOT NULL DEFAULT 0
+                )""")
+            # 旧版本的表没有 dir 列，补上并回填
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+            if 'dir' not in columns:
+                self.conn.execute("ALTER TABLE files ADD COLUMN dir TEXT")
+                rows = self.conn.execute("SELECT id, path FROM files WHERE path IS NOT NULL").fetchall()
+                self.conn.executemany(
+                    "UPDATE files SET dir = ? WHERE id = ?", [(os.path.dirname(path), idx) for idx, path in rows])
+            if 'hash' not in columns:
+                self.conn.execute("ALTER TABLE files ADD COLUMN hash TEXT")
+            if 'seq' not in columns:
+                self.conn.execute("ALTER TABLE files ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_path ON files (path)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_seq ON files (seq)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime REAL,
+                    nfiles INTEGER
+                )""")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+
+    def count(self):
+        """未删除的文件数量"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files WHERE deleted = 0").fetchone()[0]
+
+    def get_id(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def get_path(self, idx):
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM files WHERE id = ? AND deleted = 0", (int(idx),)).fetchone()
+        return row[0] if row else None
+
+    def get_paths(self, ids):
+        """批量查询路径，已删除或不存在的 id 对应 None"""
+        ids = [int(i) for i in ids]
+        found = {}
+        with self.lock:
+            # SQLite 单条语句的参数数量有上限，分段查询
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start+900]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self.conn.execute(
+                    f"SELECT id, path FROM files WHERE deleted = 0 AND id IN ({placeholders})", chunk))
+        return [found.get(i) for i in ids]
+
+    def items(self):
+        """按 id 顺序返回所有未删除的 (id, path)"""
+        with self.lock:
+            return self.conn.execute("SELECT id, path FROM files WHERE deleted = 0 ORDER BY id").fetchall()
+
+    def snapshot(self, dirs=None):
+        """未删除文件的 {path: (id, size, mtime)}，指定 dirs 时只返回这些目录中的文件"""
+        with self.lock:
+            if dirs is None:
+                rows = self.conn.execute("SELECT path, id, size, mtime FROM files WHERE deleted = 0").fetchall()
+            else:
+                dirs = list(dirs)
+                rows = []
+                for start in range(0, len(dirs), 900):
+                    chunk = dirs[start:start+900]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows.extend(self.conn.execute(
+                        f"SELECT path, id, size, mtime FROM files WHERE deleted = 0 AND dir IN ({placeholders})", chunk))
+        return {path: (idx, size, mtime) for path, idx, size, mtime in rows}
+
+    def get_dirs(self):
+        """上次扫描记录的 {path: (mtime, 文件数, [子目录])}"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, parent, mtime, nfiles FROM dirs").fetchall()
+        dirs = {path: (mtime, nfiles, []) for path, parent, mtime, nfiles in rows}
+        for path, parent, _, _ in rows:
+            if parent in dirs:
+                dirs[parent][2].append(path)
+        return dirs
+
+    def update_dirs(self, dirs, removed=()):
+        """写入 {path: (parent, mtime, 文件数)}，删除已不存在的目录记录"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dirs (path, parent, mtime, nfiles) VALUES (?, ?, ?, ?)",
+                [(path, parent, mtime, nfiles) for path, (parent, mtime, nfiles) in dirs.items()])
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", [(path,) for path in removed])
+
+    def upsert(self, records):
+        """批量写入 [(path, size, mtime), ...]，已有路径更新元信息，新路径优先复用已删除的 id，不够时分配新 id
+
+        Returns:
+            list: 按输入顺序的 [(id, path), ...]
+        """
+        result = []
+        with self.lock, self.conn:
+            next_id = self.conn.execute("SELECT COALESCE(MAX(id), -1) + 1 FROM files").fetchone()[0]
+            seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM files").fetchone()[0]
+            existing = [self.conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                        for path, _, _ in records]
+            free = [row[0] for row in self.conn.execute(
+                "SELECT id FROM files WHERE deleted = 1 ORDER BY id LIMIT ?",
+                (sum(row is None for row in existing),))]
+            free.reverse()
+            inserts = []
+            updates = []
+            for (path, size, mtime), row in zip(records, existing):
+                if row is None:
+                    if free:
+                        idx = free.pop()
+                    else:
+                        idx = next_id
+                        next_id += 1
+                    inserts.append((idx, path, size, mtime, os.path.dirname(path), seq))
+                else:
+                    idx = row[0]
+                    updates.append((size, mtime, seq, idx))
+                result.append((idx, path))
+            # 复用的 id 整行替换，deleted、hash 恢复默认值
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (id, path, size, mtime, dir, seq) VALUES (?, ?, ?, ?, ?, ?)", inserts)
+            # 内容有变化，旧的摘要作废
+            self.conn.executemany(
+                "UPDATE files SET size = ?, mtime = ?, hash = NULL, seq = ? WHERE id = ?", updates)
+        return result
+
+    def max_seq(self):
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM files").fetchone()[0]
+
+    def ids_since(self, seq):
+        """变更序号大于 seq 的未删除文件 id"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM files WHERE deleted = 0 AND seq > ? ORDER BY id", (seq,)).fetchall()
+        return [row[0] for row in rows]
+
+    def touch(self, ids):
+        """特征写入索引后更新这些文件的变更序号；查重时特征还没写入的文件会被跳过，之后的增量查重仍能查到它们"""
+        with self.lock, self.conn:
+            seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM files").fetchone()[0]
+            self.conn.executemany("UPDATE files SET seq = ? WHERE id = ?", [(seq, int(i)) for i in ids])
+
+    def set_hashes(self, records):
+        """批量写入 [(id, hash), ...]"""
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE files SET hash = ? WHERE id = ?", [(h, int(idx)) for idx, h in records])
+
+    def find_by_hash(self, hashes, exclude=()):
+        """{hash: id}，每个摘要返回一个未删除且不在 exclude 中的文件"""
+        hashes = list(hashes)
+        exclude = set(exclude)
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), 900):
+                chunk = hashes[start:start+900]
+                placeholders = ','.join('?' * len(chunk))
+                for idx, h in self.conn.execute(
+                        f"SELECT id, hash FROM files WHERE deleted = 0 AND hash IN ({placeholders}) ORDER BY id", chunk):
+                    if idx not in exclude and h not in found:
+                        found[h] = idx
+        return found
+
+    def hash_groups(self):
+        """内容完全相同的文件分组，每组为按 id 排序的 [(id, path), ...]"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT hash, id, path FROM files
+                WHERE deleted = 0 AND hash IN (
+                    SELECT hash FROM files WHERE deleted = 0 AND hash IS NOT NULL
+                    GROUP BY hash HAVING COUNT(*) > 1)
+                ORDER BY hash, id""").fetchall()
+        groups = {}
+        for h, idx, path in rows:
+            groups.setdefault(h, []).append((idx, path))
+        return list(groups.values())
+
+    def missing_hashes(self):
+        """还没有内容摘要的 [(id, path), ...]"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, path FROM files WHERE deleted = 0 AND hash IS NULL ORDER BY id").fetchall()
+
+    def tombstone_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files WHERE deleted = 1").fetchone()[0]
+
+    def get_epoch(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()
+        return row[0] if row else 0
+
+    def compact(self, live_ids, epoch):
+        """删除所有墓碑，按 live_ids 的顺序把 id 重新编号为 0..n-1，并在同一事务中记录 epoch
+
+        live_ids 须为升序，新 id 不大于旧 id，按升序逐行更新不会与尚未更新的行冲突。
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM files WHERE deleted = 1")
+            self.conn.executemany(
+                "UPDATE files SET id = ? WHERE id = ?",
+                [(new, int(old)) for new, old in enumerate(live_ids) if new != old])
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('epoch', ?)", (int(epoch),))
+
+    def mark_deleted(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE files SET path = NULL, dir = NULL, hash = NULL, deleted = 1 WHERE id = ?", [(int(i),) for i in ids])
+
+    def rename(self, old_path, new_path):
+        """原地更新路径，id 不变，无需重新提取特征"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE files SET path = ?, dir = ? WHERE path = ?", (new_path, os.path.dirname(new_path), old_path))
+
+    def migrate_from_json(self, exists_index_path, metainfo_path):
+        """从旧版 name_index.json/metainfo.json 一次性迁移，保留原有 id
+
+        迁移完成后旧文件重命名为 *.migrated，不会重复迁移。
+        """
+        if not os.path.exists(exists_index_path):
+            return 0
+        exists_index = json.loads(open(exists_index_path, 'rb').read())
+        metainfo = []
+        if os.path.exists(metainfo_path):
+            metainfo = json.loads(open(metainfo_path, 'rb').read())
+        rows = []
+        for idx, path in enumerate(exists_index):
+            if path == 'NOTEXISTS':
+                rows.append((idx, None, None, None, 1, None))
+                continue
+            # 元信息缺失时留空，下次扫描会当作已修改重新提取特征
+            size, mtime = metainfo[idx] if idx < len(metainfo) else (None, None)
+            rows.append((idx, path, size, mtime, 0, os.path.dirname(path)))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (id, path, size, mtime, deleted, dir) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        for path in [exists_index_path, metainfo_path]:
+            if os.path.exists(path):
+                os.replace(path, f'{path}.migrated')
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
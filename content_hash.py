@@ -0,0 +1,43 @@
+import os
+import hashlib
+
+
+def file_hash(path, sample_threshold=64*1024*1024, chunk_size=1024*1024):
+    """文件内容的 blake2b 摘要，读取失败时返回 None
+
+    超过 sample_threshold 的大文件只采样开头、中间、结尾各一块并混入文件大小，
+    以少量读取换取极低的误判概率。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            if size <= sample_threshold:
+                for block in iter(lambda: fp.read(chunk_size), b''):
+                    digest.update(block)
+            else:
+                digest.update(size.to_bytes(8, 'little'))
+                for offset in (0, size // 2, size - chunk_size):
+                    fp.seek(offset)
+                    digest.update(fp.read(chunk_size))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def image_hash(image):
+    """图片的内容摘要，image 可以是路径、bytes 或可 seek 的文件对象
+
+    bytes 与同样内容的小文件得到相同的摘要；文件对象读完后回到原来的位置。
+    """
+    if isinstance(image, str):
+        return file_hash(image)
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        digest.update(image)
+    else:
+        start = image.tell()
+        for block in iter(lambda: image.read(1024*1024), b''):
+            digest.update(block)
+        image.seek(start)
+    return digest.hexdigest()
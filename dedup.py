@@ -0,0 +1,196 @@
+import os
+import numpy as np
+from tqdm import tqdm
+
+
+class UnionFind:
+    """并查集，用于把两两相似的关系合并为重复组"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = self.parent.setdefault(x, x)
+        while root != self.parent[root]:
+            root = self.parent[root]
+        # 路径压缩
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def groups(self):
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return [sorted(members) for members in groups.values() if len(members) > 1]
+
+
+class DedupEngine:
+    """批量查重
+
+    按块取回特征，一次对 (B, dim) 的矩阵调用多线程 knn_query。最后一个邻居仍高于阈值的行
+    按 1.5 倍扩大 k 重新查询，且只重查这些行；每行的 k 序列与逐条查询时完全相同，结果一致。
+    backend 传给 knn_query，为空时按引擎的配置选择；与旧版逐条查询对比时指定 hnsw。
+    """
+
+    def __init__(self, ir_engine, block_size=1024, num_threads=-1, backend=None):
+        self.ir_engine = ir_engine
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.backend = backend
+
+    def iter_neighbors(self, ids, threshold, live_count=None):
+        """对每个能取回特征的 id 按顺序产出 (idx, 相似度, 邻居 id)"""
+        # 已删除的节点不会出现在结果中，k 不能超过未删除的元素数量
+        max_k = min(self.ir_engine.hnsw_index.get_current_count(), live_count or len(ids))
+        for start in range(0, len(ids), self.block_size):
+            fvs, block_ids = self.ir_engine.get_fvs(ids[start:start+self.block_size])
+            results = [None] * len(block_ids)
+            rows = np.arange(len(block_ids))
+            match_n = 5
+            while len(rows):
+                k = min(match_n, max_k)
+                labels, distances = self.ir_engine.knn_query(fvs[rows], k, num_threads=self.num_threads, backend=self.backend)
+                sims = self.ir_engine.similarity(distances)
+                # 已取到全部元素时无法再扩大 k
+                need_more = sims[:, -1] > threshold if k < max_k else np.zeros(len(rows), dtype=bool)
+                for i in np.flatnonzero(~need_more):
+                    results[rows[i]] = (sims[i], labels[i])
+                rows = rows[need_more]
+                match_n = round(match_n*1.5)
+            for row, idx in enumerate(block_ids):
+                yield (idx,) + results[row]
+
+    def find_pairs(self, exists_index, threshold, same_folder, skip_pairs=()):
+        """与旧版逐条查询的 get_duplicate 产出相同的 (path_a, path_b, 相似度)
+
+        Args:
+            exists_index (dict): 未删除文件的 {id: path}
+            skip_pairs (set): 已经给出的 (较小 id, 较大 id)，不再重复产出
+        """
+        matched = set()
+        neighbors = self.iter_neighbors(list(exists_index), threshold)
+        for idx, sim, ids in tqdm(neighbors, total=len(exists_index), ascii=True, desc='检索重复图像中'):
+            for i in range(len(ids)):
+                if ids[i] == idx:
+                    continue
+                if sim[i] < threshold:
+                    continue
+                if ids[i] in matched:
+                    continue
+                if ids[i] not in exists_index:
+                    continue
+                if (min(idx, ids[i]), max(idx, ids[i])) in skip_pairs:
+                    continue
+                if not idx in matched:
+                    matched.add(idx)
+                path_a = exists_index[idx]
+                path_b = exists_index[ids[i]]
+                if same_folder:
+                    if os.path.dirname(path_a) != os.path.dirname(path_b):
+                        continue
+                yield (path_a, path_b, sim[i])
+
+    def find_edges(self, exists_index, query_ids, threshold, same_folder):
+        """查询 query_ids 的近邻，返回相似度不低于阈值的边 {(较小 id, 较大 id): 相似度}"""
+        edges = {}
+        neighbors = self.iter_neighbors(list(query_ids), threshold, len(exists_index))
+        for idx, sim, ids in tqdm(neighbors, total=len(query_ids), ascii=True, desc='检索重复图像中'):
+            for i in range(len(ids)):
+                other = int(ids[i])
+                if other == idx or sim[i] < threshold or other not in exists_index:
+                    continue
+                if same_folder:
+                    if os.path.dirname(exists_index[idx]) != os.path.dirname(exists_index[other]):
+                        continue
+                edges[(min(idx, other), max(idx, other))] = float(sim[i])
+        return edges
+
+    def find_groups(self, exists_index, threshold, same_folder, exact_groups=(), edges=None):
+        """在阈值化的 kNN 图上求连通分量，返回重复组
+
+        每组以与组内其他图片相似度之和最大的图片为代表，成员附带与代表的相似度。
+
+        Args:
+            exists_index (dict): 未删除文件的 {id: path}
+            exact_groups (list): 内容完全相同的 id 分组，直接合并，无需检索
+            edges (dict, optional): 已经求得的边，为空时对全部文件查询
+
+        Returns:
+            list: [{'representative': path, 'members': [{'path': path, 'similarity': sim}, ...]}, ...]，按组大小降序
+        """
+        if edges is None:
+            edges = self.find_edges(exists_index, list(exists_index), threshold, same_folder)
+        uf = UnionFind()
+        strength = {}
+        for group in exact_groups:
+            for idx in group[1:]:
+                uf.union(int(group[0]), int(idx))
+        for (a, b), sim in edges.items():
+            uf.union(a, b)
+            strength[a] = strength.get(a, 0) + sim
+            strength[b] = strength.get(b, 0) + sim
+        return [self.describe_group(members, exists_index, strength) for members in
+                sorted(uf.groups(), key=len, reverse=True)]
+
+    def update_edges(self, state, exists_index, changed_ids, threshold, same_folder):
+        """增量查重：去掉涉及已删除或已变更文件的旧边，只查询变更的文件并合并结果
+
+        变更文件与全部文件之间的相似关系都能从变更文件一侧的查询得到，
+        其余文件之间的边保持不变，耗时只与变更数量成正比。
+        """
+        changed = set(changed_ids)
+        edges = {
+            (a, b): sim for (a, b), sim in state['edges'].items()
+            if a in exists_index and b in exists_index and a not in changed and b not in changed
+        }
+        edges.update(self.find_edges(exists_index, changed_ids, threshold, same_folder))
+        return edges
+
+    @staticmethod
+    def load_state(state_path):
+        """读取上次查重的结果，不存在时返回 None"""
+        if not os.path.exists(state_path):
+            return None
+        data = np.load(state_path)
+        pairs = data['pairs']
+        return {
+            'high_water': int(data['high_water']),
+            'threshold': float(data['threshold']),
+            'same_folder': bool(data['same_folder']),
+            'edges': {(int(a), int(b)): float(sim) for (a, b), sim in zip(pairs, data['sims'])},
+        }
+
+    @staticmethod
+    def save_state(state_path, edges, high_water, threshold, same_folder):
+        pairs = np.array(list(edges), dtype='int64').reshape(-1, 2)
+        sims = np.array(list(edges.values()), dtype='float32')
+        # 先写临时文件再替换，避免中途退出留下损坏的结果
+        tmp_path = f'{state_path}.tmp.npz'
+        np.savez(tmp_path, pairs=pairs, sims=sims, high_water=high_water,
+                 threshold=threshold, same_folder=same_folder)
+        os.replace(tmp_path, state_path)
+
+    def describe_group(self, members, exists_index, strength):
+        representative = max(members, key=lambda idx: strength.get(idx, 0))
+        fvs, ok_ids = self.ir_engine.get_fvs(members)
+        fvs = dict(zip(ok_ids, fvs))
+        rep_fv = fvs.get(representative)
+        result = []
+        for idx in members:
+            if idx == representative:
+                continue
+            fv = fvs.get(idx)
+            # 取不到特征的只可能是内容完全相同而合并进来的文件
+            if fv is None or rep_fv is None:
+                sim = 100.0
+            else:
+                sim = float(self.ir_engine.similarity(np.sum((fv - rep_fv) ** 2)))
+            result.append({'path': exists_index[idx], 'similarity': sim})
+        result.sort(key=lambda member: member['similarity'], reverse=True)
+        return {'representative': exists_index[representative], 'members': result}
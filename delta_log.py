@@ -0,0 +1,62 @@
+import os
+import numpy as np
+
+
+class DeltaLog:
+    """只追加的索引增量日志
+
+    每条记录为 int64 id 加 dim 个 float32 特征，按批追加并 fsync，崩溃时最多丢失正在写入的一批。
+    删除操作记录为负数 id（-id - 1），特征部分留空。加载索引时按顺序重放，
+    合并进 HNSW 索引文件后清空。
+    """
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.record_dtype = np.dtype([('id', '<i8'), ('fv', '<f4', (dim,))])
+        self.fp = None
+
+    def _write(self, records):
+        if self.fp is None:
+            self.fp = open(self.path, 'ab')
+        self.fp.write(records.tobytes())
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def append(self, fvs, ids):
+        records = np.zeros(len(ids), dtype=self.record_dtype)
+        records['id'] = ids
+        records['fv'] = fvs
+        self._write(records)
+
+    def append_deleted(self, ids):
+        records = np.zeros(len(ids), dtype=self.record_dtype)
+        records['id'] = -np.asarray(ids, dtype='int64') - 1
+        self._write(records)
+
+    def size(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def replay(self):
+        """按写入顺序返回日志中的 (ids, fvs)"""
+        size = self.size()
+        if size == 0:
+            return np.empty(0, dtype='int64'), np.empty((0, self.record_dtype['fv'].shape[0]), dtype='float32')
+        itemsize = self.record_dtype.itemsize
+        valid_size = size - size % itemsize
+        if valid_size != size:
+            # 崩溃时写了一半的末尾记录直接丢弃，保证之后追加的记录仍然对齐
+            self.close()
+            os.truncate(self.path, valid_size)
+        records = np.fromfile(self.path, dtype=self.record_dtype, count=valid_size // itemsize)
+        return records['id'], records['fv']
+
+    def truncate(self):
+        self.close()
+        open(self.path, 'wb').close()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
@@ -1,80 +1,578 @@
+import io
 import os
+import json
+import time
+import struct
 import numpy as np
 from PIL import Image
 import hnswlib
 import onnxruntime
 
+from delta_log import DeltaLog
+from exact_search import ExactSearch
+from feature_store import FeatureStore
+from projection import Projection
+from rwlock import RWLock
+
 
 class EfficientIR:
 
-    def __init__(self, img_size, index_capacity, index_path, model_path):
+    def __init__(self, img_size, index_capacity, index_path, model_path, fast_decode=True, max_decode_pixels=None,
+                 delta_compact_bytes=64*1024*1024, delta_compact_seconds=600, ef=64, M=48, ef_construction=200,
+                 feature_store_path=None, search_backend='auto', exact_threshold=100000, rerank_k=0,
+                 search_dtype='float32', session=None):
         self.img_size = img_size
+        # 新建索引时的初始容量，之后按需要成倍扩大
         self.index_capacity = index_capacity
         self.index_path = index_path
         self.model_path = model_path
+        self.fast_decode = fast_decode
+        # 单张图片解码后允许的最大像素数，超出则跳过，避免超大图片占满内存
+        self.max_decode_pixels = max_decode_pixels
+        # 增量日志超过大小或距上次合并超过时长时，合并进 HNSW 索引文件
+        self.delta_compact_bytes = delta_compact_bytes
+        self.delta_compact_seconds = delta_compact_seconds
+        # M 与 ef_construction 只在新建索引时生效，ef 为查询时的候选列表大小
+        self.ef = ef
+        self.M = M
+        self.ef_construction = ef_construction
+        # 检索后端：hnsw、exact（暴力精确检索）或 auto（库小于 exact_threshold 时精确检索）
+        self.search_backend = search_backend
+        self.exact_threshold = exact_threshold
+        # 大于查询的 k 时，先从 HNSW 或压缩后的暴力检索取 rerank_k 个候选，再按 float32 精确距离重排
+        self.rerank_k = rerank_k
+        # 暴力检索扫描用的精度：float32、float16 或按维度量化的 int8
+        self.search_dtype = search_dtype
+        # hnswlib 的 ef 是索引级别的状态：默认 ef 的查询取读锁，临时修改 ef 的查询取写锁，默认查询不会用到别人改过的 ef
+        self.ef_lock = RWLock()
+        # 查询取读锁；扩容、写入、删除以及替换索引和特征文件取写锁，hnswlib 的 resize_index 等操作不能与查询并发
+        self.lock = RWLock()
+        # 模型输出的特征维度；拟合了降维投影时 HNSW 索引建立在投影后的向量上
+        self.feature_dim = 1000
+        self.projection_path = f'{self.index_path}.pca.npz'
+        # fit_projection 时新投影先写到这里，索引写出后再替换 projection_path
+        self.pending_projection_path = f'{self.index_path}.pca.pending.npz'
+        self.meta_path = f'{self.index_path}.meta.json'
+        self.projection = Projection.load(self.projection_path)
         self.init_index()
+        self.delta_log = DeltaLog(f'{self.index_path}.delta', self.feature_dim)
+        # 所有特征另存一份按 id 寻址的内存映射文件，HNSW 索引可由它重建
+        self.feature_store = FeatureStore(feature_store_path or f'{self.index_path}.features', self.feature_dim)
+        self.exact_search = ExactSearch(self.feature_store, dtype=search_dtype, rerank_k=rerank_k)
+        # compact 的次数，与目录数据库中的记录不一致时说明上次 compact 中途退出
+        self.epoch = self.load_meta().get('epoch', 0)
         self.load_index()
-        self.init_model()
+        # 多个索引分片共用同一个推理会话
+        self.init_model(session)
         Image.MAX_IMAGE_PIXELS = None
+        # (x/255 - mean) / std 等价于 x * scale - bias，预先算好 float32 常量以便一次广播完成归一化
+        mean_vec = np.array([0.485, 0.456, 0.406]).reshape(3, 1, 1)
+        stddev_vec = np.array([0.229, 0.224, 0.225]).reshape(3, 1, 1)
+        self.norm_scale = (1 / (255 * stddev_vec)).astype('float32')
+        self.norm_bias = (mean_vec / stddev_vec).astype('float32')
 
 
-    def img_preprocess(self, image_path):
+    def load_image(self, image_path):
+        # image_path 也可以是图片的 bytes 或文件对象，上传的查询图片直接在内存中解码
+        if isinstance(image_path, (bytes, bytearray, memoryview)):
+            image_path = io.BytesIO(image_path)
+        name = image_path if isinstance(image_path, str) else '<in-memory image>'
         try:
-            img = Image.open(image_path).resize((self.img_size, self.img_size),Image.BICUBIC)
-            img = img.convert('RGBA').convert('RGB')
-        except OSError:
-            print(f'\nFile broken: {image_path}')
+            img = Image.open(image_path)
+            if self.fast_decode and img.format == 'JPEG':
+                # JPEG 在 DCT 阶段按 1/2、1/4、1/8 缩小解码，得到两边都不小于 img_size 的最小尺寸
+                img.draft(None, (self.img_size, self.img_size))
+            # 此时仅读取了文件头，尺寸已反映 draft 的缩放
+            if self.max_decode_pixels and img.width * img.height > self.max_decode_pixels:
+                print(f'\nImage too large: {name} ({img.width}x{img.height})')
+                return None
+            # reduce 不支持调色板、二值以及 I;16 系列的 16 位灰度图，这些图片直接缩放
+            if self.fast_decode and img.mode not in ('1', 'P') and not img.mode.startswith('I;16'):
+                # 其他格式先按整数倍盒式缩小，减轻后续 BICUBIC 缩放的计算量
+                factor = min(img.width, img.height) // self.img_size
+                if factor >= 2:
+                    img = img.reduce(factor)
+            img = img.resize((self.img_size, self.img_size),Image.BICUBIC)
+            # 仅在非 RGB 图片上做转换，RGBA 先转一次以处理调色板透明等情况
+            if img.mode != 'RGB':
+                img = img.convert('RGBA').convert('RGB')
+        except (OSError, ValueError):
+            # 截断、格式不支持以及 Pillow 无法处理的模式都按损坏文件跳过
+            print(f'\nFile broken: {name}')
+            return None
+        return img
+
+
+    def normalize_into(self, img, out):
+        # out 为 (3, img_size, img_size) 的 float32 缓冲区，HWC 转 CHW 只是视图，不产生拷贝
+        np.multiply(np.asarray(img).transpose(2, 0, 1), self.norm_scale, out=out)
+        out -= self.norm_bias
+        return out
+
+
+    def img_preprocess(self, image_path, out=None):
+        # out 可以是批次张量中的一个槽位，为空时新分配 (1, 3, img_size, img_size) 的张量
+        img = self.load_image(image_path)
+        if img is None:
             return None
-        input_data = np.array(img).transpose(2, 0, 1)
-        # 预处理
-        img_data = input_data.astype('float32')
-        mean_vec = np.array([0.485, 0.456, 0.406])
-        stddev_vec = np.array([0.229, 0.224, 0.225])
-        norm_img_data = np.zeros(img_data.shape).astype('float32')
-        for i in range(img_data.shape[0]):
-            norm_img_data[i,:,:] = (img_data[i,:,:]/255 - mean_vec[i]) / stddev_vec[i]
-        # add batch channel
-        norm_img_data = norm_img_data.reshape(1, 3, self.img_size, self.img_size).astype('float32')
+        if out is not None:
+            return self.normalize_into(img, out)
+        norm_img_data = np.empty((1, 3, self.img_size, self.img_size), dtype='float32')
+        self.normalize_into(img, norm_img_data[0])
         return norm_img_data
 
 
     def init_index(self):
-        self.hnsw_index = hnswlib.Index(space='l2', dim=1000)
+        self.hnsw_index = hnswlib.Index(space='l2', dim=self.index_dim())
         return self.hnsw_index
 
 
+    def index_dim(self):
+        return self.projection.dim if self.projection is not None else self.feature_dim
+
+
+    def project(self, fvs):
+        # 原始特征转换为 HNSW 索引中的向量
+        fvs = np.asarray(fvs, dtype='float32').reshape(-1, self.feature_dim)
+        return self.projection.apply(fvs) if self.projection is not None else fvs
+
+
     def load_index(self):
-        if os.path.exists(self.index_path):
-            self.hnsw_index.load_index(self.index_path, max_elements=self.index_capacity)
+        rebuild = os.path.exists(self.index_path) and self.check_projection()
+        if rebuild:
+            print(f'\nIndex dimension does not match the projection, rebuilding {self.index_path} from the feature store')
+            self.hnsw_index, _ = self._build_index(self.feature_store, self.projection)
+        elif os.path.exists(self.index_path):
+            # 按元数据记录的容量加载；旧版本的索引没有元数据，max_elements=0 时沿用文件中的容量
+            meta = self.load_meta()
+            self.hnsw_index.load_index(self.index_path, max_elements=meta.get('capacity', 0))
         else:
-            self.hnsw_index.init_index(max_elements=self.index_capacity, ef_construction=200, M=48)
+            self.hnsw_index.init_index(max_elements=self.index_capacity, ef_construction=self.ef_construction, M=self.M)
+        self.hnsw_index.set_ef(self.ef)
+        self.replay_delta()
+        # 旧版本按固定上限预分配的索引缩小到与元素数量相称的容量
+        target = max(self.index_capacity, self.hnsw_index.get_current_count() * 2)
+        if self.hnsw_index.get_max_elements() > target:
+            self.hnsw_index.resize_index(target)
+        if rebuild:
+            self.save_index()
+        self.last_compact = time.time()
+
+
+    def stored_dim(self):
+        # hnswlib 索引文件头依次为 size_t 的 offsetLevel0、max_elements、cur_element_count、size_data_per_element、
+        # label_offset、offsetData，label_offset 与 offsetData 之差即每个向量的字节数
+        with open(self.index_path, 'rb') as fp:
+            header = fp.read(48)
+        label_offset, offset_data = struct.unpack('<2Q', header[32:48])
+        return (label_offset - offset_data) // 4
+
+
+    def check_projection(self):
+        """核对索引文件与投影的维度，fit_projection 中途退出留下的不一致能修复时直接修复
+
+        hnswlib 按构造时的维度加载索引文件，不会检查文件中的维度，维度不一致时查询结果毫无意义。
+
+        Returns:
+            bool: 无法对应到任何投影，需要由特征文件重建索引
+        """
+        dim = self.stored_dim()
+        pending = Projection.load(self.pending_projection_path)
+        if dim == self.index_dim():
+            if pending is not None:
+                # 新投影写出后、索引写出前退出，索引仍是旧的
+                os.remove(self.pending_projection_path)
+            return False
+        if pending is not None and pending.dim == dim:
+            # 索引已按新投影写出，投影文件还没替换
+            os.replace(self.pending_projection_path, self.projection_path)
+            self.projection = pending
+        elif dim == self.feature_dim:
+            # 索引已去掉投影，投影文件还没删除
+            if os.path.exists(self.projection_path):
+                os.remove(self.projection_path)
+            self.projection = None
+        else:
+            return True
+        self.init_index()
+        return False
+
+
+    def load_meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        return json.loads(open(self.meta_path, 'rb').read())
+
+
+    def save_meta(self):
+        meta = {
+            'capacity': self.hnsw_index.get_max_elements(),
+            'count': self.hnsw_index.get_current_count(),
+            'dim': self.hnsw_index.dim,
+            'M': self.M,
+            'ef_construction': self.ef_construction,
+            'epoch': self.epoch,
+        }
+        tmp_path = f'{self.meta_path}.tmp'
+        with open(tmp_path, 'wb') as wp:
+            wp.write(json.dumps(meta, indent=2).encode('UTF-8'))
+            wp.flush()
+            os.fsync(wp.fileno())
+        os.replace(tmp_path, self.meta_path)
+
+
+    def reserve(self, size):
+        """容量不足 size 时把 HNSW 索引成倍扩大，返回是否扩容
+
+        resize_index 与并发查询同时进行并不安全，扩容在写锁内完成。
+        """
+        with self.lock.write():
+            capacity = self.hnsw_index.get_max_elements()
+            if size <= capacity:
+                return False
+            capacity = max(capacity, 1)
+            while capacity < size:
+                capacity *= 2
+            self.hnsw_index.resize_index(capacity)
+            return True
+
+
+    def replay_delta(self):
+        ids, fvs = self.delta_log.replay()
+        if len(ids) == 0:
+            return
+        deleted = ids < 0
+        self.reserve(self.hnsw_index.get_current_count() + int(np.count_nonzero(~deleted)))
+        # 按写入顺序分段重放，每段内全部是新增或全部是删除
+        for seg in np.split(np.arange(len(ids)), np.flatnonzero(np.diff(deleted)) + 1):
+            if deleted[seg[0]]:
+                self._mark_deleted(-ids[seg] - 1)
+                self.feature_store.invalidate(-ids[seg] - 1)
+            else:
+                self.hnsw_index.add_items(self.project(fvs[seg]), ids[seg])
+                self.feature_store.put(fvs[seg], ids[seg])
+        self.feature_store.flush()
 
 
     def save_index(self):
-        self.hnsw_index.save_index(self.index_path)
+        with self.lock.write():
+            # 完整写出索引文件，此后增量日志中的记录都已包含在内
+            self.feature_store.flush()
+            # 先写临时文件并落盘再替换，写出中途崩溃时原索引文件与增量日志仍然完好，重放后不丢数据
+            tmp_path = f'{self.index_path}.tmp'
+            self.hnsw_index.save_index(tmp_path)
+            with open(tmp_path, 'rb+') as fp:
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.index_path)
+            self.save_meta()
+            self.delta_log.truncate()
+            self.last_compact = time.time()
+
+
+    def maybe_compact(self):
+        if self.delta_log.size() == 0:
+            return False
+        if self.delta_log.size() < self.delta_compact_bytes and time.time() - self.last_compact < self.delta_compact_seconds:
+            return False
+        self.save_index()
+        return True
+
+
+    def close(self):
+        if self.delta_log.size() > 0:
+            self.save_index()
+        self.feature_store.flush()
+        self.delta_log.close()
 
 
-    def init_model(self):
-        self.session_opti = onnxruntime.SessionOptions()
-        self.session_opti.enable_mem_pattern = False
-        self.session = onnxruntime.InferenceSession(self.model_path, self.session_opti)
+    def init_model(self, session=None):
+        if session is None:
+            self.session_opti = onnxruntime.SessionOptions()
+            self.session_opti.enable_mem_pattern = False
+            session = onnxruntime.InferenceSession(self.model_path, self.session_opti)
+        self.session = session
         # self.session.set_providers(['DmlExecutionProvider'])
         self.model_input = self.session.get_inputs()[0].name
+        # 批次维度为符号/None 时模型支持动态批次，否则只能逐张推理
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.dynamic_batch = not isinstance(batch_dim, int)
         return self.session, self.model_input
 
 
     def get_fv(self, image_path):
+        # 接受路径、bytes 或文件对象
         norm_img_data = self.img_preprocess(image_path)
         if norm_img_data is None:
             return None
         return self.session.run([], {self.model_input: norm_img_data})[0][0]
 
 
+    def infer_batch(self, batch):
+        if self.dynamic_batch:
+            return self.session.run([], {self.model_input: batch})[0]
+        # 固定批次为 1 的模型退化为逐张推理
+        return np.concatenate([self.session.run([], {self.model_input: batch[i:i+1]})[0] for i in range(len(batch))])
+
+
+    def get_fv_batch(self, image_paths):
+        # 返回 (M, dim) 特征矩阵以及成功处理的图片在输入中的下标，损坏的图片直接跳过
+        batch = np.empty((len(image_paths), 3, self.img_size, self.img_size), dtype='float32')
+        valid = []
+        for i, image_path in enumerate(image_paths):
+            # 成功的图片依次写入下一个槽位，损坏的图片不会在批次中留下空洞
+            if self.img_preprocess(image_path, batch[len(valid)]) is None:
+                continue
+            valid.append(i)
+        if not valid:
+            return np.empty((0, self.feature_dim), dtype='float32'), valid
+        return self.infer_batch(batch[:len(valid)]), valid
+
+
     def add_fv(self, fv, idx):
-        self.hnsw_index.add_items(fv, idx)
+        fvs = np.asarray(fv, dtype='float32').reshape(-1, self.feature_dim)
+        ids = np.atleast_1d(idx)
+        with self.lock.write():
+            self.reserve(self.hnsw_index.get_current_count() + len(ids))
+            self.hnsw_index.add_items(self.project(fvs), ids)
+            self.feature_store.put(fvs, ids)
+            self.delta_log.append(fvs, ids)
+
+
+    def backfill_store(self, ids):
+        """把特征文件中缺少的特征从 HNSW 索引补齐，用于升级前建立的索引"""
+        with self.lock.write():
+            ids = np.asarray(ids, dtype='int64')
+            missing = ids[~self.feature_store.is_valid(ids)]
+            done = 0
+            for start in range(0, len(missing), 65536):
+                fvs, ok_ids = self._get_items(missing[start:start+65536])
+                self.feature_store.put(fvs, ok_ids)
+                done += len(ok_ids)
+            self.feature_store.flush()
+            return done
+
+
+    def rebuild_index(self, num_threads=-1, block_size=65536):
+        """由特征文件重建 HNSW 索引，不需要重新推理
+
+        按当前的 M、ef_construction 新建索引，多线程分块 add_items，完成后替换现有索引并写出。
+        """
+        return self._rebuild(self.projection, num_threads, block_size)
+
+
+    def _rebuild(self, projection, num_threads=-1, block_size=65536):
+        with self.lock.write():
+            index, count = self._build_index(self.feature_store, projection, num_threads, block_size)
+            # 索引与投影一起替换，查询不会用新投影去查旧索引
+            self.hnsw_index, self.projection = index, projection
+            self.save_index()
+            return count
+
+
+    def _build_index(self, store, projection, num_threads=-1, block_size=65536):
+        ids = store.valid_ids()
+        index = hnswlib.Index(space='l2', dim=projection.dim if projection is not None else self.feature_dim)
+        # 留出一倍的余量，避免重建后马上扩容
+        index.init_index(max_elements=max(self.index_capacity, len(ids) * 2), ef_construction=self.ef_construction, M=self.M)
+        for start in range(0, len(ids), block_size):
+            chunk = ids[start:start+block_size]
+            fvs = store.data[chunk]
+            index.add_items(projection.apply(fvs) if projection is not None else fvs, chunk, num_threads=num_threads)
+        index.set_ef(self.ef)
+        return index, len(ids)
+
+
+    def prepare_compact(self, live_ids, num_threads=-1):
+        """按 live_ids 的顺序把特征重新编号为 0..n-1，写出临时特征文件并建好紧凑的索引
+
+        耗时的部分都在这里完成，此时还没有替换任何文件；目录重新编号后再调用 finish_compact。
+        """
+        with self.lock.read():
+            store = self.feature_store.compact_to(live_ids, self.compact_path())
+            index, _ = self._build_index(store, self.projection, num_threads)
+            return store, index
+
+
+    def finish_compact(self, prepared, epoch):
+        """目录已按 epoch 重新编号后调用，换入紧凑的特征文件和索引，索引元数据记录新的 epoch"""
+        with self.lock.write():
+            store, index = prepared
+            self.feature_store.replace_with(store)
+            self.hnsw_index = index
+            self.epoch = epoch
+            self.save_index()
+
+
+    def compact_path(self):
+        return f'{self.feature_store.path}.compact'
+
+
+    def recover_compact(self, epoch):
+        """目录已按 epoch 重新编号而索引还停留在之前时（finish_compact 中途退出），换入剩余的紧凑文件并重建索引"""
+        with self.lock.write():
+            self.feature_store.replace_from(self.compact_path())
+            self.epoch = epoch
+            return self._rebuild(self.projection)
+
+
+    def discard_compact(self):
+        # 目录还没有重新编号时退出，紧凑文件作废
+        FeatureStore.discard(self.compact_path())
+
+
+    def nbytes(self):
+        """HNSW 索引与特征文件按容量估算的内存占用：(索引, 特征文件)
+
+        hnswlib 第 0 层每个元素占向量、2M 条边加计数和 8 字节标签，上层节点很少，忽略不计。
+        """
+        with self.lock.read():
+            element = self.hnsw_index.dim * 4 + self.M * 2 * 4 + 4 + 8
+            return self.hnsw_index.get_max_elements() * element, self.feature_store.nbytes()
+
+
+    def fit_projection(self, n_components, whiten=False, sample=20000, calibrate_queries=1000, num_threads=-1):
+        """在库中抽样拟合 PCA 投影，并在投影后的向量上重建 HNSW 索引
+
+        用抽样查询与其原始空间的精确近邻校准距离比例。n_components 为 0 时去掉投影，恢复原始维度的索引。
+
+        Returns:
+            float: 保留的方差比例，去掉投影时为 1
+        """
+        if not n_components:
+            self._rebuild(None, num_threads)
+            if os.path.exists(self.projection_path):
+                os.remove(self.projection_path)
+            return 1.0
+        with self.lock.read():
+            ids = self.feature_store.valid_ids()
+            if not len(ids):
+                raise ValueError('No features to fit the projection on')
+            rng = np.random.default_rng(0)
+            sample_ids = np.sort(rng.choice(ids, size=min(sample, len(ids)), replace=False))
+            samples = self.feature_store.data[sample_ids]
+            queries = samples[:calibrate_queries]
+            labels, _ = self.exact_search.search(queries, min(10, len(ids)))
+            neighbors = self.feature_store.data[labels.ravel()].reshape(labels.shape + (-1,))
+        projection = Projection.fit(samples, n_components, whiten)
+        projection.calibrate(queries, neighbors)
+        # 新投影先写入临时文件，索引写出后再替换；中途退出时 load_index 按索引文件的维度采用其中之一
+        projection.save(self.pending_projection_path)
+        self._rebuild(projection, num_threads)
+        os.replace(self.pending_projection_path, self.projection_path)
+        return projection.explained
+
+
+    def get_fv_by_id(self, idx):
+        with self.lock.read():
+            # 取回已入库的特征，不存在时返回 None
+            fvs, ok_ids = self.feature_store.get([int(idx)])
+            if ok_ids or self.projection is not None:
+                # 降维后 HNSW 索引中只有投影后的向量，无法还原原始特征
+                return fvs[0] if ok_ids else None
+            try:
+                return np.asarray(self.hnsw_index.get_items([int(idx)])[0], dtype='float32')
+            except RuntimeError:
+                return None
+
+
+    def get_fvs(self, ids):
+        with self.lock.read():
+            # 批量取回特征，返回 (特征矩阵, 成功取回的 id)，优先读特征文件，缺少的再从 HNSW 索引取
+            ids = np.asarray(ids, dtype='int64')
+            valid = self.feature_store.is_valid(ids)
+            fvs, ok_ids = self.feature_store.get(ids[valid])
+            if valid.all():
+                return fvs, ok_ids
+            rest_fvs, rest_ids = self._get_items(ids[~valid])
+            return np.concatenate([fvs, rest_fvs]), ok_ids + rest_ids
+
+
+    def _get_items(self, ids):
+        # 从 HNSW 索引取回特征，整批失败时逐个重试以跳过缺失的 id
+        ids = [int(i) for i in ids]
+        if self.projection is not None:
+            return np.empty((0, self.feature_dim), dtype='float32'), []
+        try:
+            return np.asarray(self.hnsw_index.get_items(ids), dtype='float32').reshape(-1, self.feature_dim), ids
+        except RuntimeError:
+            pass
+        fvs = []
+        ok_ids = []
+        for idx in ids:
+            fv = self.get_fv_by_id(idx)
+            if fv is not None:
+                fvs.append(fv)
+                ok_ids.append(idx)
+        return np.asarray(fvs, dtype='float32').reshape(-1, self.feature_dim), ok_ids
+
+
+    def _mark_deleted(self, ids):
+        for idx in ids:
+            try:
+                self.hnsw_index.mark_deleted(int(idx))
+            except RuntimeError:
+                # 重复删除时 hnswlib 报 already deleted，忽略即可
+                pass
+
+
+    def mark_deleted(self, ids):
+        with self.lock.write():
+            self._mark_deleted(ids)
+            self.feature_store.invalidate(ids)
+            self.delta_log.append_deleted(ids)
+
+
+    def similarity(self, distances):
+        # hnswlib 的 l2 距离映射为 0~100 的相似度
+        return (1-np.tanh(distances/3000))*100
+
+
+    def resolve_backend(self, backend=None):
+        backend = backend or self.search_backend
+        if backend == 'auto':
+            return 'exact' if self.hnsw_index.get_current_count() < self.exact_threshold else 'hnsw'
+        if backend not in ('hnsw', 'exact'):
+            raise ValueError(f'Unknown search backend: {backend}')
+        return backend
+
+
+    def knn_query(self, fvs, k, ef=None, num_threads=-1, backend=None):
+        with self.lock.read():
+            # 返回 (labels, distances)，形式与 hnswlib 的 knn_query 相同
+            if self.resolve_backend(backend) == 'exact':
+                return self.exact_search.search(fvs, k)
+            candidates = min(self.rerank_k, self.hnsw_index.get_current_count())
+            if candidates > k:
+                try:
+                    labels, _ = self.hnsw_knn_query(fvs, candidates, ef, num_threads)
+                    return self.exact_search.rerank(fvs, labels, k)
+                except RuntimeError:
+                    # 未删除的元素不足 candidates 个时 hnswlib 报错，退回普通查询
+                    pass
+            return self.hnsw_knn_query(fvs, k, ef, num_threads)
+
+
+    def hnsw_knn_query(self, fvs, k, ef=None, num_threads=-1):
+        with self.lock.read():
+            fvs = self.project(fvs)
+            # ef 小于 k 时 hnswlib 实际按 k 搜索，这里显式取较大值
+            if ef is None:
+                with self.ef_lock.read():
+                    labels, distances = self.hnsw_index.knn_query(fvs, k=k, num_threads=num_threads)
+            else:
+                with self.ef_lock.write():
+                    self.hnsw_index.set_ef(max(ef, k))
+                    try:
+                        labels, distances = self.hnsw_index.knn_query(fvs, k=k, num_threads=num_threads)
+                    finally:
+                        self.hnsw_index.set_ef(self.ef)
+            if self.projection is not None:
+                # 降维空间的距离换算回原始空间的尺度，相似度映射不变
+                distances = distances / self.projection.distance_scale
+            return labels, distances
 
 
-    def match(self, fv, nc=5):
-        query = self.hnsw_index.knn_query(fv, k=nc)
-        similarity = (1-np.tanh(query[1][0]/3000))*100
+    def match(self, fv, nc=5, ef=None, backend=None):
+        query = self.knn_query(fv, nc, ef, backend=backend)
+        similarity = self.similarity(query[1][0])
         return similarity, query[0][0]
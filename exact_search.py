@@ -0,0 +1,164 @@
+import threading
+import numpy as np
+from collections import namedtuple
+
+
+SEARCH_DTYPES = ('float32', 'float16', 'int8')
+
+# 扫描用的一份完整数据：参与扫描的 id、还原后向量的范数、压缩后的特征（float32 时为 None）以及 int8 的量化参数
+# 特征文件有变化时整体构建新的一份再替换，扫描只使用开始时取到的那一份
+ScanState = namedtuple('ScanState', ['version', 'ids', 'norms', 'codes', 'scale', 'offset'])
+
+
+class ExactSearch:
+    """基于特征文件的精确暴力检索
+
+    ||q - x||² = ||q||² - 2q·x + ||x||²，按块从内存映射的特征矩阵取出向量做一次矩阵乘法，
+    距离与 hnswlib 的 l2 空间（平方距离）一致。库中向量的范数缓存起来，特征文件有变化时只重新计算变化的行。
+
+    dtype 为 float16 或 int8 时在内存中保存一份压缩后的特征用于扫描，int8 按维度做标量量化
+    x ≈ code * scale + offset，新增的特征超出原有量化范围时才重新统计全库。扫描得到 max(k, rerank_k) 个候选后，从 float32 特征文件取回原始特征
+    重排，返回的距离仍是精确值；float32 文件只读取候选所在的行。
+    """
+
+    def __init__(self, feature_store, block_size=8192, dtype='float32', rerank_k=0):
+        if dtype not in SEARCH_DTYPES:
+            raise ValueError(f'Unsupported search dtype: {dtype}')
+        self.feature_store = feature_store
+        self.block_size = block_size
+        self.dtype = dtype
+        self.rerank_k = rerank_k
+        self.lock = threading.Lock()
+        self.state = ScanState(None, np.empty(0, dtype='int64'), np.empty(0, dtype='float32'), None, None, None)
+
+    def _prepare(self):
+        """返回与特征文件当前版本一致的 ScanState，有变化时重新构建"""
+        with self.lock:
+            if self.state.version != self.feature_store.version:
+                version, changed = self.feature_store.changed_since(self.state.version)
+                state = self._update(self.state, version, changed) if changed is not None else None
+                self.state = state if state is not None else self._build(version)
+            return self.state
+
+    def _update(self, state, version, changed):
+        """只对有变化的 id 重新编码和计算范数；int8 的新特征超出量化范围时返回 None，由调用方完整重建"""
+        keep = ~np.isin(state.ids, changed)
+        added = changed[self.feature_store.is_valid(changed)]
+        block = self.feature_store.data[added]
+        if self.dtype == 'int8' and len(added):
+            # 舍入到最近的码值，超出半个量化步长以内的值不影响编码
+            lo = state.offset - 128.5 * state.scale
+            hi = state.offset + 127.5 * state.scale
+            if (block.min(axis=0) < lo).any() or (block.max(axis=0) > hi).any():
+                return None
+        codes = None
+        if state.codes is not None:
+            codes = np.concatenate([state.codes[keep], self._encode(state, block).astype(self.dtype)])
+        ids = np.concatenate([state.ids[keep], added])
+        updated = state._replace(version=version, ids=ids, codes=codes)
+        block = self._decode(updated, len(ids) - len(added), len(ids))
+        return updated._replace(norms=np.concatenate([state.norms[keep], np.einsum('ij,ij->i', block, block)]))
+
+    def _build(self, version):
+        # 完整读取特征文件；调用时文件可能已比 version 更新，之后按变更记录再处理一遍结果不变
+        ids = self.feature_store.valid_ids()
+        scale, offset = self._fit_scale(ids) if self.dtype == 'int8' else (None, None)
+        codes = np.empty((len(ids), self.feature_store.dim), dtype=self.dtype) if self.dtype != 'float32' else None
+        norms = np.empty(len(ids), dtype='float32')
+        state = ScanState(version, ids, norms, codes, scale, offset)
+        for start in range(0, len(ids), self.block_size):
+            stop = min(start + self.block_size, len(ids))
+            if codes is not None:
+                codes[start:stop] = self._encode(state, self.feature_store.data[ids[start:stop]])
+            # 压缩时范数按还原后的向量计算，与扫描时的距离展开式一致
+            block = self._decode(state, start, stop)
+            norms[start:stop] = np.einsum('ij,ij->i', block, block)
+        return state
+
+    def _fit_scale(self, ids):
+        # 按维度统计全库的最小值和最大值，把 [lo, hi] 线性映射到 [-128, 127]
+        lo = np.full(self.feature_store.dim, np.inf, dtype='float32')
+        hi = np.full(self.feature_store.dim, -np.inf, dtype='float32')
+        for start in range(0, len(ids), self.block_size):
+            block = self.feature_store.data[ids[start:start+self.block_size]]
+            lo = np.minimum(lo, block.min(axis=0))
+            hi = np.maximum(hi, block.max(axis=0))
+        if not len(ids):
+            lo[:], hi[:] = 0, 1
+        scale = np.where(hi > lo, (hi - lo) / 255, 1).astype('float32')
+        return scale, (lo + 128 * scale).astype('float32')
+
+    def _encode(self, state, block):
+        if self.dtype == 'int8':
+            return np.clip(np.rint((block - state.offset) / state.scale), -128, 127)
+        return block
+
+    def _decode(self, state, start, stop):
+        # 第 start 到 stop 行还原为 float32
+        if state.codes is None:
+            return self.feature_store.data[state.ids[start:stop]]
+        block = state.codes[start:stop].astype('float32')
+        if state.scale is not None:
+            block *= state.scale
+            block += state.offset
+        return block
+
+    def nbytes(self):
+        """扫描时常驻内存的字节数，float32 时为需要读入的特征文件行"""
+        state = self._prepare()
+        data = state.codes.nbytes if state.codes is not None else len(state.ids) * self.feature_store.dim * 4
+        return data + state.norms.nbytes + state.ids.nbytes
+
+    def search(self, queries, k):
+        """返回与 hnswlib knn_query 相同形式的 (labels, distances)，按距离升序"""
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.feature_store.dim)
+        if self.dtype == 'float32':
+            return self.scan(queries, k)
+        labels, _ = self.scan(queries, max(k, self.rerank_k))
+        return self.rerank(queries, labels, k)
+
+    def scan(self, queries, k):
+        """在扫描用的矩阵上求 k 近邻，压缩时距离为近似值"""
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.feature_store.dim)
+        state = self._prepare()
+        ids, norms = state.ids, state.norms
+        k = min(k, len(ids))
+        best_dist = np.full((len(queries), k), np.inf, dtype='float32')
+        best_ids = np.full((len(queries), k), -1, dtype='int64')
+        if k == 0:
+            return best_ids, best_dist
+        query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+        for start in range(0, len(ids), self.block_size):
+            stop = min(start + self.block_size, len(ids))
+            block = self._decode(state, start, stop)
+            dist = query_norms - 2 * queries @ block.T + norms[None, start:stop]
+            # 与当前最优合并后保留最小的 k 个
+            all_dist = np.concatenate([best_dist, dist], axis=1)
+            all_ids = np.concatenate([best_ids, np.broadcast_to(ids[start:stop], dist.shape)], axis=1)
+            top = np.argpartition(all_dist, k - 1, axis=1)[:, :k]
+            best_dist = np.take_along_axis(all_dist, top, axis=1)
+            best_ids = np.take_along_axis(all_ids, top, axis=1)
+        return self._sorted(best_ids, best_dist)
+
+    def rerank(self, queries, candidates, k):
+        """对近似检索得到的候选 id 从 float32 特征文件计算精确距离，保留最近的 k 个
+
+        取不到特征的候选（已删除）距离记为无穷大，排在最后。
+        """
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.feature_store.dim)
+        candidates = np.asarray(candidates, dtype='int64')
+        valid = self.feature_store.is_valid(candidates.ravel()).reshape(candidates.shape)
+        fvs = np.zeros(candidates.shape + (self.feature_store.dim,), dtype='float32')
+        fvs[valid] = self.feature_store.data[candidates[valid]]
+        diff = fvs - queries[:, None, :]
+        dist = np.einsum('ijk,ijk->ij', diff, diff)
+        dist[~valid] = np.inf
+        k = min(k, candidates.shape[1])
+        top = np.argpartition(dist, k - 1, axis=1)[:, :k] if k else np.empty((len(queries), 0), dtype='int64')
+        return self._sorted(np.take_along_axis(candidates, top, axis=1), np.take_along_axis(dist, top, axis=1))
+
+    def _sorted(self, labels, distances):
+        order = np.argsort(distances, axis=1)
+        # 展开公式在向量非常接近时可能得到微小的负数
+        distances = np.maximum(np.take_along_axis(distances, order, axis=1), 0)
+        return np.take_along_axis(labels, order, axis=1), distances.astype('float32')
@@ -0,0 +1,173 @@
+import os
+import threading
+import numpy as np
+from collections import deque
+
+
+class FeatureStore:
+    """按 id 寻址的内存映射特征文件
+
+    <path>.f32 为 (capacity, dim) 的 float32 原始矩阵，第 i 行即 id 为 i 的特征；
+    <path>.valid 为有效位图，每个 id 占 1 bit。容量不足时按倍数扩展文件。
+    HNSW 索引可以随时由这里的特征重建，无需重新推理。
+
+    (data, valid, capacity) 作为一个元组整体替换，扩容时其他线程读到的总是同一组映射与容量。
+    """
+
+    def __init__(self, path, dim, capacity=1024):
+        self.path = path
+        self.data_path = f'{path}.f32'
+        self.valid_path = f'{path}.valid'
+        self.dim = dim
+        # 每次写入或作废时递增，供缓存判断特征是否有变化
+        self.version = 0
+        # 最近的写入与作废记录 (版本, ids)，精确检索据此只重新编码有变化的行
+        self.changes = deque(maxlen=1024)
+        self.changes_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.data_path)), exist_ok=True)
+        existing = 0
+        if os.path.exists(self.data_path):
+            existing = os.path.getsize(self.data_path) // (dim * 4)
+        self.state = self._open(max(existing, capacity))
+
+    def _open(self, capacity):
+        """映射 capacity 行的文件，返回 (data, valid, capacity)，不修改当前状态"""
+        # 扩展文件长度（多数文件系统上为稀疏文件，不会立即占用磁盘）
+        for path, size in [(self.data_path, capacity * self.dim * 4), (self.valid_path, (capacity + 7) // 8)]:
+            with open(path, 'ab') as fp:
+                if fp.tell() < size:
+                    fp.truncate(size)
+        data = np.memmap(self.data_path, dtype='float32', mode='r+', shape=(capacity, self.dim))
+        valid = np.memmap(self.valid_path, dtype='uint8', mode='r+', shape=((capacity + 7) // 8,))
+        return data, valid, capacity
+
+    @property
+    def data(self):
+        return self.state[0]
+
+    @property
+    def valid(self):
+        return self.state[1]
+
+    @property
+    def capacity(self):
+        return self.state[2]
+
+    def ensure_capacity(self, size):
+        if size <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        self.flush()
+        # 新的映射建好后一次替换，旧映射在没有引用后释放
+        self.state = self._open(capacity)
+
+    def is_valid(self, ids):
+        _, valid, capacity = self.state
+        ids = np.asarray(ids, dtype='int64')
+        ok = ids < capacity
+        result = np.zeros(len(ids), dtype=bool)
+        result[ok] = (valid[ids[ok] >> 3] >> (ids[ok] & 7)) & 1
+        return result
+
+    def put(self, fvs, ids):
+        ids = np.asarray(ids, dtype='int64')
+        if len(ids) == 0:
+            return
+        self.ensure_capacity(int(ids.max()) + 1)
+        data, valid, _ = self.state
+        data[ids] = fvs
+        np.bitwise_or.at(valid, ids >> 3, (1 << (ids & 7)).astype('uint8'))
+        self._changed(ids)
+
+    def get(self, ids):
+        """返回 (特征矩阵, 有效的 id)，无效的 id 被跳过"""
+        data, valid, capacity = self.state
+        ids = np.asarray(ids, dtype='int64')
+        ids = ids[ids < capacity]
+        ids = ids[((valid[ids >> 3] >> (ids & 7)) & 1).astype(bool)]
+        return np.array(data[ids]), ids.tolist()
+
+    def invalidate(self, ids):
+        _, valid, capacity = self.state
+        ids = np.asarray(ids, dtype='int64')
+        ids = ids[ids < capacity]
+        np.bitwise_and.at(valid, ids >> 3, (~(1 << (ids & 7))).astype('uint8'))
+        self._changed(ids)
+
+    def _changed(self, ids):
+        with self.changes_lock:
+            self.version += 1
+            self.changes.append((self.version, ids.copy()))
+
+    def changed_since(self, version):
+        """返回 (当前版本, version 之后写入或作废过的 id)；记录已不完整时 id 为 None，需要全部重新读取"""
+        with self.changes_lock:
+            if version == self.version:
+                return self.version, np.empty(0, dtype='int64')
+            if version is None or not self.changes or self.changes[0][0] > version + 1:
+                return self.version, None
+            changed = [ids for v, ids in self.changes if v > version]
+            return self.version, np.unique(np.concatenate(changed))
+
+    def valid_ids(self):
+        _, valid, capacity = self.state
+        bits = np.unpackbits(np.asarray(valid), bitorder='little')[:capacity]
+        return np.flatnonzero(bits)
+
+    def count(self):
+        return int(np.unpackbits(np.asarray(self.valid)).sum())
+
+    def nbytes(self):
+        _, valid, capacity = self.state
+        return capacity * self.dim * 4 + len(valid)
+
+    def compact_to(self, ids, path):
+        """把 ids 对应的特征按顺序写入 path 处的新文件，第 i 个 id 的特征成为新文件的第 i 行"""
+        ids = np.asarray(ids, dtype='int64')
+        # 之前中途放弃的 compact 可能留下同名文件，其中的有效位不能沿用
+        FeatureStore.discard(path)
+        store = FeatureStore(path, self.dim, capacity=max(1024, len(ids)))
+        block_size = 65536
+        for start in range(0, len(ids), block_size):
+            chunk = ids[start:start+block_size]
+            valid = self.is_valid(chunk)
+            store.put(self.data[chunk[valid]], np.flatnonzero(valid) + start)
+        store.flush()
+        return store
+
+    def replace_with(self, store):
+        """用 compact_to 得到的文件替换当前文件"""
+        store.flush()
+        # Windows 上被映射的文件无法替换，先释放新文件的映射
+        store.state = None
+        self.replace_from(store.path)
+
+    def replace_from(self, path):
+        """用 path 处 compact_to 写出的文件替换当前文件
+
+        两个文件分别替换，中途退出时已替换的文件不再存在，再次调用即可完成剩余的部分。
+        """
+        self.flush()
+        self.state = None
+        for src, dst in [(f'{path}.f32', self.data_path), (f'{path}.valid', self.valid_path)]:
+            if os.path.exists(src):
+                os.replace(src, dst)
+        self.state = self._open(os.path.getsize(self.data_path) // (self.dim * 4))
+        with self.changes_lock:
+            # id 全部重新编号，之前的变更记录作废
+            self.version += 1
+            self.changes.clear()
+
+    @staticmethod
+    def discard(path):
+        """删除 path 处 compact_to 写出、尚未用于替换的文件"""
+        for file_path in [f'{path}.f32', f'{path}.valid']:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def flush(self):
+        data, valid, _ = self.state
+        data.flush()
+        valid.flush()
@@ -2,7 +2,8 @@ import os
 import sys
 import json
 from PyQt5 import QtCore, QtWidgets, uic
-from utils import Utils
+from shards import ShardManager
+from utils import DEFAULT_PATHS, Utils
 
 
 def resource_path(relative_path):
@@ -19,11 +20,18 @@ def resource_path(relative_path):
 QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, True)
 config_path = resource_path('gui/config.json')
 config = json.loads(open(config_path, 'rb').read())
+# 旧版本的配置文件缺少新增的路径项，补上默认值后再转换路径，保存设置时一并写回
+for key, value in DEFAULT_PATHS.items():
+    config.setdefault(key, value)
 config_clone = config.copy()  # 备份以便于在写入文件中恢复相对路径
 paths_to_convert = ['web_path', 'web_cache_path', 'index_path',
-                    'model_path', 'exists_index_path', 'metainfo_path', 'ui']
+                    'model_path', 'exists_index_path', 'metainfo_path', 'catalog_path',
+                    'dedup_state_path', 'feature_store_path', 'shard_dir', 'ui']
 config.update({key: resource_path(config[key]) for key in paths_to_convert})
-utils = Utils(config)
+# sharded 为真时每个索引目录使用独立的索引分片
+utils = ShardManager(config) if config.get('sharded', False) else Utils(config)
+# 目录修改时间不可靠的文件系统（部分网络磁盘）可以用 --full 启动，每次都完整扫描
+full_rescan = '--full' in sys.argv
 Ui_MainWindow, QtBaseClass = uic.loadUiType(config['ui'])
 
 
@@ -33,25 +41,17 @@ class IndexThread(QtCore.QThread):
     progress_signal = QtCore.pyqtSignal(int)  # 进度信号
     completed_signal = QtCore.pyqtSignal()     # 完成信号
 
-    def __init__(self, utils_instance):
+    def __init__(self, utils_instance, full=None):
         QtCore.QThread.__init__(self)
         self.utils = utils_instance
+        self.full = full
 
     def run(self):
-        self.utils.remove_nonexists()
         self.progress_signal.emit(0)
-        need_indexs = []
-        for image_dir in config['search_dir']:
-            need_index = self.utils.index_target_dir(image_dir)
-            need_indexs.extend(need_index)
-        if len(need_index) == 0:
-            self.progress_signal.emit(100)
-        for i, (idx, fpath) in enumerate(need_indexs):
-            self.utils.update_ir_index(idx, fpath)
-            progress = int((i + 1) / len(need_indexs) * 100)
+        for done, total in self.utils.update(config['search_dir'], self.full):
+            progress = int(done / total * 100) if total else 100
             # 更新进度条信号发射到主线程
             self.progress_signal.emit(progress)
-        self.utils.exists_index = self.utils.get_exists_index()
         self.completed_signal.emit()  # 发出完成信号
         self.requestInterruption()  # 退出线程，防止内存泄漏
         return
@@ -80,9 +80,6 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
         self.removeInvalidIndex.clicked.connect(self.remove_invalid_index)
 
     def _init_ui_(self):
-        if os.path.exists(utils.exists_index_path):
-            # 加载索引
-            self.exists_index = utils.get_exists_index()
         self.resultTable.horizontalHeader().setSectionResizeMode(
             0, QtWidgets.QHeaderView.Stretch)              # 填充显示表格
         self.resultTable.setEditTriggers(
@@ -130,12 +127,13 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
         if self.input_path[0] == '':
             delattr(self, 'input_path')
             return
-        if (config['search_dir'] == []) or (not os.path.exists(utils.exists_index_path)):
+        index_count = utils.count()
+        if (config['search_dir'] == []) or index_count == 0:
             QtWidgets.QMessageBox.information(self, '提示', '索引都没有建搜你🐎 搜')
             return
         nc = self.resultCount.value()
-        nc = nc if nc <= len(self.exists_index) else len(self.exists_index)
-        results = utils.checkout(self.input_path[0], self.exists_index, nc)
+        nc = nc if nc <= index_count else index_count
+        results = utils.checkout(self.input_path[0], nc)
         for i in results:
             row = self.resultTable.rowCount()
             self.resultTable.insertRow(row)
@@ -149,26 +147,34 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
 
     # 检测图片是否重复
     def start_search_duplicate(self):
-        if (config['search_dir'] == []) or (not os.path.exists(utils.exists_index_path)):
+        if (config['search_dir'] == []) or utils.count() == 0:
             QtWidgets.QMessageBox.information(self, '提示', '索引都没有建查你🐎 查')
             return
         self.resultTableDuplicate.setRowCount(
             0)                                                        # 清空表格
         threshold = self.similarityThreshold.value()
         same_folder = self.sameFolder.isChecked()
-        for i in utils.get_duplicate(self.exists_index, threshold, same_folder):
-            row = self.resultTableDuplicate.rowCount()
-            self.resultTableDuplicate.insertRow(row)
-            item_path_a = QtWidgets.QTableWidgetItem(i[0])
-            item_path_a.setToolTip(f'{i[0]}<br><img width=300 src="{i[0]}">')
-            item_path_b = QtWidgets.QTableWidgetItem(i[1])
-            item_path_b.setToolTip(f'{i[1]}<br><img width=300 src="{i[1]}">')
-            item_sim = QtWidgets.QTableWidgetItem(f'{i[2]:.2f} %')
-            item_sim.setTextAlignment(
-                QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.resultTableDuplicate.setItem(row, 0, item_path_a)
-            self.resultTableDuplicate.setItem(row, 1, item_path_b)
-            self.resultTableDuplicate.setItem(row, 2, item_sim)
+        # 参数与上次相同时只检查上次之后新增或修改的图片
+        groups = utils.get_duplicate_groups(threshold, same_folder, incremental=True)
+        # 每组的代表图片占第一列，其余成员各占一行；一次性设定行数并暂停排序，避免逐行插入的开销
+        self.resultTableDuplicate.setSortingEnabled(False)
+        self.resultTableDuplicate.setRowCount(sum(len(group['members']) for group in groups))
+        row = 0
+        for group in groups:
+            representative = group['representative']
+            for member in group['members']:
+                item_path_a = QtWidgets.QTableWidgetItem(representative)
+                item_path_a.setToolTip(f'{representative}<br><img width=300 src="{representative}">')
+                item_path_b = QtWidgets.QTableWidgetItem(member['path'])
+                item_path_b.setToolTip(f'{member["path"]}<br><img width=300 src="{member["path"]}">')
+                item_sim = QtWidgets.QTableWidgetItem(f'{member["similarity"]:.2f} %')
+                item_sim.setTextAlignment(
+                    QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+                self.resultTableDuplicate.setItem(row, 0, item_path_a)
+                self.resultTableDuplicate.setItem(row, 1, item_path_b)
+                self.resultTableDuplicate.setItem(row, 2, item_sim)
+                row += 1
+        self.resultTableDuplicate.setSortingEnabled(True)
 
     def update_dir_table(self):
         self.searchDirTable.setRowCount(0)
@@ -189,13 +195,12 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
 
     def remove_invalid_index(self):
         utils.remove_nonexists()
-        self.exists_index = utils.get_exists_index()
         QtWidgets.QMessageBox.information(self, '提示', '无效索引已删除')
 
     def sync_index(self):
         # 创建并启动索引同步的后台线程
         if self.index_thread is None or not self.index_thread.isRunning():
-            self.index_thread = IndexThread(utils)
+            self.index_thread = IndexThread(utils, full_rescan or None)
             # self.index_thread.update_signal.connect(self.update_status)
             self.progress_dialog = QtWidgets.QProgressDialog(self)  # 创建进度条对话框
             self.progress_dialog.setWindowTitle("更新索引")  # 设置窗口标题
@@ -223,7 +228,6 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
         self.index_thread.quit()
         self.index_thread.wait()
         self.index_thread.finished.connect(self.index_thread.deleteLater)
-        self.exists_index = utils.get_exists_index()  # 重新获取已存在索引,解决建立索引后立即执行搜索大概率不生效的问题
 
     def update_progress_bar(self, progress):
         self.progress_dialog.setValue(progress)
@@ -233,6 +237,7 @@ class MainUI(QtWidgets.QMainWindow, Ui_MainWindow):
         if self.index_thread is not None and self.index_thread.isRunning():
             self.index_thread.quit()
             self.index_thread.wait()
+        utils.close()
         event.accept()
 
     def save_settings(self):
@@ -0,0 +1,48 @@
+import itertools
+import threading
+
+
+# 进程内全局递增，分片卸载后重新加载也不会与之前的代号重复
+_generations = itertools.count(1)
+
+
+class PathView:
+    """进程内唯一的 id→路径视图
+
+    每次提交都复制出新的字典并整体替换，同时换上新的代号；读者用 snapshot() 一次取得 (代号, 字典)，
+    看到的总是某一代的完整状态，不会读到更新了一半的内容。已发布的字典不再修改，读者不需要加锁。
+    """
+
+    def __init__(self, items=()):
+        self.lock = threading.Lock()
+        self.state = (next(_generations), dict(items))
+
+    def snapshot(self):
+        return self.state
+
+    @property
+    def generation(self):
+        return self.state[0]
+
+    def __len__(self):
+        return len(self.state[1])
+
+    def get_paths(self, ids):
+        """已删除或不存在的 id 对应 None"""
+        paths = self.state[1]
+        return [paths.get(int(i)) for i in ids]
+
+    def reset(self, items):
+        with self.lock:
+            self.state = (next(_generations), dict(items))
+
+    def commit(self, removed=(), added=()):
+        """删除 removed 中的 id 并写入 added 中的 (id, path)，两者都为空时只更换代号，表示索引中的特征有变化"""
+        with self.lock:
+            paths = self.state[1]
+            if len(removed) or len(added):
+                paths = dict(paths)
+                for idx in removed:
+                    paths.pop(int(idx), None)
+                paths.update((int(idx), path) for idx, path in added)
+            self.state = (next(_generations), paths)
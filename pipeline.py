@@ -0,0 +1,108 @@
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class IndexPipeline:
+    """解码/预处理与模型推理并行的索引流水线
+
+    工作线程池负责解码并归一化图片（PIL 解码、缩放以及 numpy 运算期间会释放 GIL，
+    因此线程即可并行），推理阶段按提交顺序取出结果组成批次送入模型。
+    批次张量在 prefetch_batches + 1 个预分配缓冲区之间轮换，内存占用有界，
+    输出顺序与输入顺序一致。
+    """
+
+    def __init__(self, ir_engine, batch_size=16, workers=4, prefetch_batches=2):
+        self.ir_engine = ir_engine
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch_batches = prefetch_batches
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {
+            'images': 0,            # 已处理的文件数
+            'indexed': 0,           # 成功提取特征的文件数
+            'decode_seconds': 0.0,  # 所有工作线程解码耗时之和
+            'infer_seconds': 0.0,   # 推理耗时
+            'wait_seconds': 0.0,    # 推理阶段等待解码结果的耗时
+            'elapsed_seconds': 0.0,
+        }
+
+    def _decode(self, image_path, out):
+        start = time.perf_counter()
+        try:
+            ok = self.ir_engine.img_preprocess(image_path, out) is not None
+        except Exception as e:
+            # 单个文件的意外错误只跳过这个文件，不中断整次索引
+            print(f'\nFailed to decode {image_path}: {e!r}')
+            ok = False
+        return ok, time.perf_counter() - start
+
+    def run(self, need_index):
+        """处理 [(idx, fpath), ...]，每个批次产出 (ids, fvs, 已处理数量)"""
+        self.stats = self._empty_stats()
+        run_start = time.perf_counter()
+        img_size = self.ir_engine.img_size
+        # 预分配的批次张量，工作线程直接写入各自的槽位；
+        # 一个用于推理，其余用于预取，用完后回收复用
+        free_buffers = [
+            np.empty((self.batch_size, 3, img_size, img_size), dtype='float32')
+            for _ in range(self.prefetch_batches + 1)
+        ]
+        items = iter(need_index)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+
+            def fill():
+                while free_buffers:
+                    chunk = list(islice(items, self.batch_size))
+                    if not chunk:
+                        return
+                    buffer = free_buffers.pop()
+                    futures = [pool.submit(self._decode, fpath, buffer[slot])
+                               for slot, (_, fpath) in enumerate(chunk)]
+                    pending.append((chunk, futures, buffer))
+
+            fill()
+            while pending:
+                chunk, futures, buffer = pending.popleft()
+                wait_start = time.perf_counter()
+                valid = []
+                for slot, future in enumerate(futures):
+                    ok, seconds = future.result()
+                    self.stats['decode_seconds'] += seconds
+                    if ok:
+                        valid.append(slot)
+                self.stats['wait_seconds'] += time.perf_counter() - wait_start
+                ids = [chunk[slot][0] for slot in valid]
+                fvs = None
+                if ids:
+                    # 有损坏图片时才需要挑出有效槽位，否则直接使用缓冲区视图
+                    batch = buffer[:len(chunk)] if len(valid) == len(chunk) else buffer[valid]
+                    infer_start = time.perf_counter()
+                    fvs = self.ir_engine.infer_batch(batch)
+                    self.stats['infer_seconds'] += time.perf_counter() - infer_start
+                free_buffers.append(buffer)
+                fill()
+                self.stats['images'] += len(chunk)
+                self.stats['indexed'] += len(ids)
+                self.stats['elapsed_seconds'] = time.perf_counter() - run_start
+                yield ids, fvs, self.stats['images']
+
+    def report(self):
+        """各阶段吞吐量，推理阶段等待时间占比高说明瓶颈在解码"""
+        stats = self.stats
+        images = stats['images']
+        elapsed = stats['elapsed_seconds'] or 1e-9
+        # 解码阶段由多个线程并行，其理论吞吐量按线程数折算
+        decode_rate = images / (stats['decode_seconds'] or 1e-9) * self.workers
+        infer_rate = stats['indexed'] / (stats['infer_seconds'] or 1e-9)
+        return (f'{images} files in {elapsed:.2f}s ({images/elapsed:.1f} files/s), '
+                f'decode {decode_rate:.1f} img/s ({self.workers} workers), '
+                f'inference {infer_rate:.1f} img/s, '
+                f'inference waited {stats["wait_seconds"]/elapsed*100:.0f}% of the time')
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+
+
+class Projection:
+    """PCA（可选白化）降维
+
+    HNSW 索引建立在降维后的向量上，特征文件和增量日志仍保存原始特征。
+    distance_scale 为降维空间与原始空间近邻距离的比例，查询结果按它换算回原始尺度，
+    相似度映射 (1 - tanh(d/3000)) * 100 不需要改动。
+    """
+
+    def __init__(self, mean, components, distance_scale=1.0, explained=None):
+        self.mean = np.asarray(mean, dtype='float32')
+        # (n_components, dim)，白化时已除以各主成分的标准差
+        self.components = np.asarray(components, dtype='float32')
+        self.distance_scale = float(distance_scale)
+        self.explained = explained
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, samples, n_components, whiten=False):
+        samples = np.asarray(samples, dtype='float64')
+        mean = samples.mean(axis=0)
+        cov = np.cov(samples - mean, rowvar=False)
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        # eigh 按特征值升序返回，取最大的 n_components 个
+        order = np.argsort(eigvals)[::-1][:n_components]
+        components = eigvecs[:, order].T
+        if whiten:
+            components = components / np.sqrt(np.maximum(eigvals[order], 1e-12))[:, None]
+        explained = float(eigvals[order].sum() / eigvals.sum())
+        return cls(mean, components, explained=explained)
+
+    def calibrate(self, queries, neighbors):
+        """用查询与其精确近邻 (n, k, dim) 的距离拟合 d_proj ≈ distance_scale * d_raw"""
+        queries = np.asarray(queries, dtype='float32')
+        neighbors = np.asarray(neighbors, dtype='float32')
+        raw = np.sum((neighbors - queries[:, None, :]) ** 2, axis=2)
+        projected = np.sum((self.apply(neighbors.reshape(-1, neighbors.shape[2])).reshape(
+            neighbors.shape[0], neighbors.shape[1], -1) - self.apply(queries)[:, None, :]) ** 2, axis=2)
+        denom = float(np.sum(raw * raw))
+        self.distance_scale = float(np.sum(projected * raw)) / denom if denom > 0 else 1.0
+        return self.distance_scale
+
+    def apply(self, fvs):
+        return ((np.asarray(fvs, dtype='float32') - self.mean) @ self.components.T).astype('float32')
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, mean=self.mean, components=self.components,
+                 distance_scale=self.distance_scale, explained=self.explained or 0.0)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """读取保存的投影，不存在时返回 None"""
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        return cls(data['mean'], data['components'], float(data['distance_scale']), float(data['explained']))
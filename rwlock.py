@@ -0,0 +1,58 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """读写锁：读者之间可以并发，写者独占
+
+    有写者等待时新的读者排队，持续的查询不会让写入一直等下去。同一线程可以重入：
+    持有读锁时可以再取读锁，持有写锁时可以再取读锁或写锁；持有读锁时不能再取写锁。
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = {}
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers[me] -= 1
+                if not self.readers[me]:
+                    del self.readers[me]
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer != me:
+                if me in self.readers:
+                    raise RuntimeError('Cannot upgrade a read lock to a write lock')
+                self.waiting_writers += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.cond.wait()
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = me
+            self.write_depth += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.write_depth -= 1
+                if not self.write_depth:
+                    self.writer = None
+                    self.cond.notify_all()
@@ -0,0 +1,90 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+ACCEPTED_EXTS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif', '.webp')
+
+# files: 列举过的目录中的 {path: (size, mtime)}
+# dirs: 本次访问到的所有目录 {path: (parent, mtime, 文件数)}
+# listed: 实际列举了内容的目录，其余目录的修改时间未变，沿用目录中的记录
+# failed: 无法访问的目录
+ScanResult = namedtuple('ScanResult', ['files', 'dirs', 'listed', 'failed'])
+
+
+class Scanner:
+    """基于 os.scandir 的并行目录扫描
+
+    每一层目录交给线程池并行列举，文件大小和修改时间直接取自 DirEntry.stat()，
+    每个文件只做一次 stat（Windows 上由目录列举结果缓存，不产生额外的系统调用）。
+
+    传入上次记录的目录信息时为增量扫描：目录的修改时间只在其直接包含的条目增删、
+    重命名时变化，修改时间未变的目录不再列举，只继续检查其已知的子目录。
+    原地修改文件内容不会改变目录修改时间，目录修改时间不可靠的文件系统需要完整扫描。
+    """
+
+    def __init__(self, workers=8, accepted_exts=ACCEPTED_EXTS):
+        self.workers = workers
+        self.accepted_exts = tuple(accepted_exts)
+
+    def scan_dir(self, dir_path, known_dirs=None):
+        """扫描单个目录
+
+        Returns:
+            tuple: (目录修改时间, [(path, size, mtime), ...] 或 None（未列举）, [子目录])，无法访问时为 None
+        """
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime
+        except OSError:
+            return None
+        known = known_dirs.get(dir_path) if known_dirs else None
+        if known is not None and known[0] == dir_mtime:
+            return dir_mtime, None, known[2]
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(self.accepted_exts):
+                            stat = entry.stat()
+                            files.append((entry.path, stat.st_size, stat.st_mtime))
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return dir_mtime, files, subdirs
+
+    def scan(self, roots, known_dirs=None):
+        """扫描多个根目录
+
+        Args:
+            roots (list): 根目录
+            known_dirs (dict, optional): 上次记录的 {path: (mtime, 文件数, [子目录])}，为空时完整扫描
+
+        Returns:
+            ScanResult: 扫描结果
+        """
+        result = ScanResult({}, {}, [], [])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            level = [(root, None) for root in roots]
+            while level:
+                next_level = []
+                scanned = pool.map(lambda item: self.scan_dir(item[0], known_dirs), level)
+                for (dir_path, parent), scanned_dir in zip(level, scanned):
+                    if scanned_dir is None:
+                        result.failed.append(dir_path)
+                        continue
+                    dir_mtime, dir_files, subdirs = scanned_dir
+                    if dir_files is None:
+                        result.dirs[dir_path] = (parent, dir_mtime, known_dirs[dir_path][1])
+                    else:
+                        result.dirs[dir_path] = (parent, dir_mtime, len(dir_files))
+                        result.listed.append(dir_path)
+                        for path, size, mtime in dir_files:
+                            result.files[path] = (size, mtime)
+                    next_level.extend((subdir, dir_path) for subdir in subdirs)
+                level = next_level
+        return result
@@ -0,0 +1,345 @@
+import os
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from cache import LRUCache
+from catalog import Catalog
+from content_hash import image_hash
+from utils import DEFAULT_PATHS, Utils
+
+
+class ShardManager:
+    """按索引目录分片的索引管理，接口与 Utils 相同
+
+    search_dir 中的每个目录对应一个分片，分片有独立的目录数据库、特征文件和 HNSW 索引，
+    存放在 shard_dir 下以目录路径摘要命名的子目录中，增删一个目录只涉及它自己的分片。
+    分片在用到时才加载，加载的分片超过 max_loaded_shards 时卸载最久未使用且空闲的分片。
+    加载和卸载都不持有全局锁，同一分片的并发请求等待同一个加载结果，不会阻塞其他分片。
+    查询在线程池中并行发往各分片，按距离合并前 k 个结果，可以只查询指定的目录。
+    所有分片共用一个 ONNX 推理会话。查重在每个分片内部进行，不跨分片比较。
+    查询结果缓存在这一层，任何分片有修改都会更换 generation，旧结果不再命中。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.shard_dir = config.get('shard_dir', DEFAULT_PATHS['shard_dir'])
+        self.max_loaded = config.get('max_loaded_shards', 4)
+        self.lock = threading.Lock()
+        # root → Future，加载中的分片也在其中，完成后结果是 Utils 实例
+        self.loaded = OrderedDict()
+        # 正在卸载的分片，重新加载前要等它关闭完成
+        self.closing = {}
+        self.in_use = {}
+        # 分片记录数的缓存，未加载的分片不必每次打开目录数据库
+        self.counts = {}
+        self.session = None
+        self.pool = ThreadPoolExecutor(max_workers=config.get('shard_query_threads', 4))
+        self.generation = 0
+        self.feature_cache = LRUCache(config.get('feature_cache_size', 1024), config.get('query_cache_ttl', 600))
+        self.result_cache = LRUCache(config.get('result_cache_size', 256), config.get('query_cache_ttl', 600))
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+    def shard_path(self, root):
+        name = hashlib.blake2b(os.path.normpath(root).encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.shard_dir, name)
+
+    def shard_config(self, root):
+        path = self.shard_path(root)
+        config = dict(self.config)
+        config.update({
+            'index_path': os.path.join(path, 'index.bin'),
+            'catalog_path': os.path.join(path, 'catalog.db'),
+            'feature_store_path': os.path.join(path, 'features'),
+            'dedup_state_path': os.path.join(path, 'dedup_state.npz'),
+            'exists_index_path': os.path.join(path, 'name_index.json'),
+            'metainfo_path': os.path.join(path, 'metainfo.json'),
+            'search_dir': [root],
+        })
+        return config
+
+    def roots(self):
+        """磁盘上已有分片的索引目录"""
+        roots = []
+        for entry in os.scandir(self.shard_dir):
+            root_file = os.path.join(entry.path, 'root.txt')
+            if entry.is_dir() and os.path.exists(root_file):
+                roots.append(open(root_file, 'r', encoding='utf-8').read())
+        return roots
+
+    def _load(self, root):
+        path = self.shard_path(root)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'root.txt'), 'w', encoding='utf-8') as fp:
+            fp.write(root)
+        shard = Utils(self.shard_config(root), self.session)
+        with self.lock:
+            if self.session is None:
+                self.session = shard.ir_engine.session
+        return shard
+
+    def _finish_load(self, root, future, closing):
+        """在全局锁之外加载分片并发布到 future，失败时移除占位，下次使用时重新加载"""
+        try:
+            if closing is not None:
+                closing.result()
+            shard = self._load(root)
+        except BaseException as e:
+            with self.lock:
+                if self.loaded.get(root) is future:
+                    del self.loaded[root]
+            future.set_exception(e)
+            raise
+        future.set_result(shard)
+
+    def _evict(self):
+        """锁内挑出要卸载的空闲分片，锁外关闭"""
+        victims = []
+        with self.lock:
+            for root in list(self.loaded):
+                if len(self.loaded) <= self.max_loaded:
+                    break
+                if self.in_use.get(root):
+                    continue
+                # 空闲的分片都已加载成功，加载失败的占位已由加载线程移除
+                done = Future()
+                self.closing[root] = done
+                victims.append((root, self.loaded.pop(root).result(), done))
+        for root, shard, done in victims:
+            try:
+                count = shard.count()
+                shard.close()
+                with self.lock:
+                    self.counts[root] = count
+            finally:
+                with self.lock:
+                    if self.closing.get(root) is done:
+                        del self.closing[root]
+                done.set_result(None)
+
+    @contextmanager
+    def using(self, root):
+        """加载（如果尚未加载）并占用分片，占用期间不会被卸载"""
+        root = os.path.normpath(root)
+        with self.lock:
+            future = self.loaded.get(root)
+            loader = future is None
+            if loader:
+                future = Future()
+                self.loaded[root] = future
+                closing = self.closing.get(root)
+            self.loaded.move_to_end(root)
+            self.in_use[root] = self.in_use.get(root, 0) + 1
+        try:
+            if loader:
+                self._finish_load(root, future, closing)
+            shard = future.result()
+            self._evict()
+            yield shard
+        finally:
+            with self.lock:
+                self.in_use[root] -= 1
+            self._evict()
+
+    def _changed(self):
+        with self.lock:
+            self.generation += 1
+
+    def root_of(self, path):
+        """包含 path 的索引目录，不在任何索引目录下时返回 None"""
+        for root in self.config['search_dir']:
+            root = os.path.normpath(root)
+            if os.path.normpath(path) == root or os.path.normpath(path).startswith(os.path.join(root, '')):
+                return root
+        return None
+
+    def drop(self, root):
+        """删除分片，不影响其他分片"""
+        root = os.path.normpath(root)
+        with self.lock:
+            if self.in_use.get(root):
+                return False
+            future = self.loaded.pop(root, None)
+            closing = self.closing.get(root)
+            self.counts.pop(root, None)
+        # 未被占用的分片一定已加载完成
+        if future is not None:
+            future.result().close()
+        if closing is not None:
+            closing.result()
+        shutil.rmtree(self.shard_path(root), ignore_errors=True)
+        return True
+
+    def count(self):
+        total = 0
+        for root in self.roots():
+            with self.lock:
+                future = self.loaded.get(root)
+                count = self.counts.get(root)
+            if future is not None and future.done() and future.exception() is None:
+                count = future.result().count()
+            elif count is not None:
+                total += count
+                continue
+            else:
+                # 没有缓存的未加载分片只打开目录数据库计数，不加载索引
+                catalog = Catalog(self.shard_config(root)['catalog_path'])
+                count = catalog.count()
+                catalog.close()
+            with self.lock:
+                self.counts[root] = count
+            total += count
+        return total
+
+    def update(self, search_dirs, full=None):
+        """同步所有分片，产出 (已处理数量, 总数)；已不在 search_dirs 中的目录的分片直接删除"""
+        roots = list(dict.fromkeys(os.path.normpath(d) for d in search_dirs))
+        for root in set(self.roots()) - set(roots):
+            self.drop(root)
+        pending = []
+        for root in roots:
+            with self.using(root) as shard, shard.maintenance_lock:
+                need_index = shard.sync_index([root], full)
+                pending.append((root, shard.ir_engine.epoch, need_index, shard.missing_hashes(need_index)))
+        self._changed()
+        total = sum(len(need_index) + len(missing) for _, _, need_index, missing in pending)
+        yield 0, total
+        done = 0
+        for root, epoch, need_index, missing in pending:
+            if not need_index and not missing:
+                continue
+            with self.using(root) as shard, shard.maintenance_lock:
+                if shard.ir_engine.epoch != epoch:
+                    # 两个阶段之间分片被 compact 重新编号，重新同步取得新的 id；没有特征的文件会重新排队
+                    need_index = shard.sync_index([root], full)
+                    missing = shard.missing_hashes(need_index)
+                # 与 Utils.update 相同，先补算已入库文件的内容摘要
+                for shard_done in shard.backfill_hashes(missing):
+                    yield done + shard_done, total
+                done += len(missing)
+                for shard_done in shard.update_ir_index(need_index):
+                    self._changed()
+                    yield done + shard_done, total
+            done += len(need_index)
+
+    def checkout(self, image_path, match_n=5, ef=None, backend=None, roots=None, digest=None):
+        """在各分片上并行查询并按距离合并，roots 为空时查询所有索引目录
+
+        roots 可以是索引目录的子目录，此时只查询所属的分片，并按路径前缀过滤结果。
+        """
+        scopes = {}
+        for folder in roots or self.config['search_dir']:
+            root = self.root_of(folder)
+            if root is not None:
+                scopes.setdefault(root, []).append(os.path.join(os.path.normpath(folder), ''))
+        if not scopes:
+            return []
+        # 调用方已算好摘要时直接使用，不再重复读取图片
+        digest = digest or image_hash(image_path)
+        if digest is None:
+            return []
+        # 先取代号再查询，查询期间分片有变化时结果记在旧代号下，之后的查询不会命中
+        key = (digest, match_n, ef, backend, tuple(roots or ()), self.generation)
+        results = self.result_cache.get(key)
+        if results is not None:
+            return list(results)
+        fv = self.feature_cache.get(digest)
+        with self.using(next(iter(scopes))) as shard:
+            if fv is None:
+                fv = shard.batcher.embed(image_path)
+            similarity = shard.ir_engine.similarity
+        if fv is None:
+            return []
+        self.feature_cache.put(digest, fv)
+
+        def query(root):
+            with self.using(root) as shard:
+                nc = min(match_n, shard.count())
+                if nc == 0:
+                    return []
+                while True:
+                    # 与 Utils.checkout 相同，查询与取路径之间分片被 compact 重新编号时重新查询
+                    epoch = shard.ir_engine.epoch
+                    labels, distances = shard.ir_engine.knn_query(fv, nc, ef, backend=backend)
+                    paths = shard.paths.get_paths(labels[0])
+                    if shard.ir_engine.epoch == epoch:
+                        break
+            prefixes = tuple(scopes[root])
+            # 查询整个分片时前缀就是分片目录本身，过滤不会去掉任何结果
+            return [(d, p) for d, p in zip(distances[0], paths) if p is not None and os.path.join(p, '').startswith(prefixes)]
+
+        merged = sorted((item for items in self.pool.map(query, scopes) for item in items), key=lambda item: item[0])
+        results = [(similarity(d), p) for d, p in merged[:match_n]]
+        self.result_cache.put(key, results)
+        return list(results)
+
+    def rename(self, old_path, new_path):
+        root = self.root_of(old_path)
+        if root is not None:
+            with self.using(root) as shard:
+                shard.rename(old_path, new_path)
+            self._changed()
+
+    def remove_nonexists(self):
+        for root in self.roots():
+            with self.using(root) as shard:
+                shard.remove_nonexists()
+        self._changed()
+
+    def get_duplicate_groups(self, threshold, same_folder, incremental=False):
+        groups = []
+        for root in self.roots():
+            with self.using(root) as shard:
+                groups.extend(shard.get_duplicate_groups(threshold, same_folder, incremental))
+        groups.sort(key=lambda group: len(group['members']), reverse=True)
+        return groups
+
+    def compact(self, force=False):
+        reports = {}
+        for root in self.roots():
+            with self.using(root) as shard:
+                reports[root] = shard.compact(force)
+        self._changed()
+        return reports
+
+    def rebuild_index(self):
+        total = 0
+        for root in self.roots():
+            with self.using(root) as shard:
+                total += shard.rebuild_index()
+        self._changed()
+        return total
+
+    def fit_projection(self, n_components, whiten=False):
+        explained = {}
+        for root in self.roots():
+            with self.using(root) as shard:
+                explained[root] = shard.fit_projection(n_components, whiten)
+        self._changed()
+        return explained
+
+    def stats(self):
+        """查询缓存以及已加载分片的统计信息"""
+        with self.lock:
+            futures = list(self.loaded.items())
+        shards = {root: future.result().stats() for root, future in futures if future.done() and future.exception() is None}
+        return {
+            'feature_cache': self.feature_cache.stats(),
+            'result_cache': self.result_cache.stats(),
+            'shards': shards,
+        }
+
+    def close(self):
+        self.pool.shutdown()
+        with self.lock:
+            futures = list(self.loaded.values())
+            closing = list(self.closing.values())
+            self.loaded.clear()
+        for future in futures:
+            if future.exception() is None:
+                future.result().close()
+        for done in closing:
+            done.result()
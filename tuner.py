@@ -0,0 +1,30 @@
+import time
+import numpy as np
+
+
+def tune_ef(ir_engine, ids, k=20, sample=500, target_recall=0.95,
+            ef_candidates=(16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512), seed=0):
+    """离线调整查询时的 ef
+
+    从库中抽样 sample 张图片作为查询，暴力计算精确近邻后对每个候选 ef 统计 recall@k
+    与单条查询延迟，返回 (满足目标召回率的最小 ef, [(ef, recall, 延迟毫秒), ...])。
+    没有候选满足目标时返回召回率最高的 ef。小于 k 的候选按 k 计，所有候选都小于 k 时只测 ef=k。
+    """
+    rng = np.random.default_rng(seed)
+    sample_ids = rng.choice(ids, size=min(sample, len(ids)), replace=False)
+    queries, sample_ids = ir_engine.get_fvs(sample_ids)
+    k = min(k, len(ids))
+    truth = ir_engine.exact_search.search(queries, k)[0]
+    curve = []
+    # hnswlib 实际按 max(ef, k) 搜索
+    for ef in sorted({max(ef, k) for ef in ef_candidates}):
+        start = time.perf_counter()
+        # 单线程逐条查询，延迟与在线检索时一致
+        labels = np.vstack([ir_engine.hnsw_knn_query(queries[i:i+1], k, ef, num_threads=1)[0] for i in range(len(queries))])
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(labels[i]) & set(truth[i])) / k for i in range(len(queries))])
+        curve.append((ef, float(recall), latency))
+    chosen = next((ef for ef, recall, _ in curve if recall >= target_recall), None)
+    if chosen is None:
+        chosen = max(curve, key=lambda point: point[1])[0]
+    return chosen, curve
@@ -1,142 +1,468 @@
 import os
-import json
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from batcher import QueryBatcher
+from cache import LRUCache
+from catalog import Catalog
+from content_hash import file_hash, image_hash
+from dedup import DedupEngine
 from efficient_ir import EfficientIR
+from path_view import PathView
+from pipeline import IndexPipeline
+from scanner import Scanner
 
 from PyQt5.QtWidgets import QProgressDialog,QMessageBox,QApplication
 import PyQt5.QtCore as QtCore
 
 
-NOTEXISTS = 'NOTEXISTS'
+# 后续版本新增的路径配置项，旧的 config.json 中没有这些键时使用的默认值
+DEFAULT_PATHS = {
+    'catalog_path': 'index/catalog.db',
+    'dedup_state_path': 'index/dedup_state.npz',
+    'feature_store_path': 'index/features',
+    'shard_dir': 'index/shards',
+}
 
 
 class Utils:
 
-    def __init__(self, config):
+    def __init__(self, config, session=None):
         self.metainfo_path = config['metainfo_path']
         self.exists_index_path = config['exists_index_path']
+        self.catalog = Catalog(config.get('catalog_path', DEFAULT_PATHS['catalog_path']))
+        # 扫描、写入特征、改名、删除与 compact 互斥，compact 重新编号期间不会有按旧 id 写入的目录记录或特征；
+        # 直接调用 sync_index、update_ir_index 时由调用方持有
+        self.maintenance_lock = threading.Lock()
+        # 检索时从这里把 id 换成路径，目录数据库只在写入时访问
+        self.paths = PathView()
+        self.scanner = Scanner(config.get('scan_workers', 8))
+        self.full_rescan = config.get('full_rescan', False)
+        self.index_batch_size = config.get('index_batch_size', 16)
+        self.decode_workers = config.get('decode_workers', 4)
+        self.prefetch_batches = config.get('prefetch_batches', 2)
         self.ir_engine = EfficientIR(
             config['img_size'],
             config['index_capacity'],
             config['index_path'],
             config['model_path'],
+            config.get('fast_decode', True),
+            config.get('max_decode_pixels'),
+            config.get('delta_compact_bytes', 64*1024*1024),
+            config.get('delta_compact_seconds', 600),
+            ef=config.get('ef', 64),
+            M=config.get('M', 48),
+            ef_construction=config.get('ef_construction', 200),
+            feature_store_path=config.get('feature_store_path', DEFAULT_PATHS['feature_store_path']),
+            search_backend=config.get('search_backend', 'auto'),
+            exact_threshold=config.get('exact_threshold', 100000),
+            rerank_k=config.get('rerank_k', 0),
+            search_dtype=config.get('search_dtype', 'float32'),
+            session=session,
+        )
+        # 墓碑占目录的比例超过该值时 compact 才会重建
+        self.compact_tombstone_fraction = config.get('compact_tombstone_fraction', 0.2)
+        self.dedup_state_path = config.get('dedup_state_path', DEFAULT_PATHS['dedup_state_path'])
+        # 并发的检索请求合并成批推理和查询
+        self.batcher = QueryBatcher(
+            self.ir_engine,
+            config.get('batch_max_size', 8),
+            config.get('batch_max_wait_ms', 5),
+        )
+        # 图片内容摘要 -> 特征向量，以及 (摘要, 查询参数, 索引代号) -> 查询结果
+        self.feature_cache = LRUCache(config.get('feature_cache_size', 1024), config.get('query_cache_ttl', 600))
+        self.result_cache = LRUCache(config.get('result_cache_size', 256), config.get('query_cache_ttl', 600))
+        self.dedup_engine = DedupEngine(
+            self.ir_engine,
+            config.get('dedup_block_size', 1024),
+            config.get('dedup_threads', -1),
         )
         self.check_env()
 
 
     def check_env(self):
-        if not os.path.exists(self.exists_index_path):
-            parent_path = os.path.join(self.exists_index_path, os.pardir)
-            os.makedirs(os.path.abspath(parent_path), exist_ok=True)
-            with open(self.exists_index_path, 'w') as wp:
-                wp.write("[]")
-
-
-    def get_exists_index(self):
-        return json.loads(open(self.exists_index_path, 'rb').read())
-
-
-    def get_file_list(self, target_dir):
-        accepted_exts = ['.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif', '.webp']
-        file_path_list = []
-        for root, dirs, files in os.walk(target_dir):
-            for name in files:
-                if name.lower().endswith(tuple(accepted_exts)):
-                    file_path_list.append(os.path.join(root, name))
-        return file_path_list
-
-
-    def index_target_dir(self, target_dir):
-        # 如果已有文件索引就加载
-        exists_index = []
-        if os.path.exists(self.exists_index_path):
-            exists_index = json.loads(open(self.exists_index_path, 'rb').read())
-        # 如果已有元信息索引就加载
-        metainfo = []
-        if os.path.exists(self.metainfo_path):
-            metainfo = json.loads(open(self.metainfo_path, 'rb').read())
-        # 枚举当前指定目录的所有文件全路径
-        this_index = self.get_file_list(target_dir)
-        # 需要特征索引的文件
-        need_index = []
-        # 更新文件索引
-        for i in this_index:
-            if not i in exists_index:
-                exists_index.append(i)
-        # 更新元信息索引
-        for i in range(len(exists_index)):
-            if NOTEXISTS in exists_index[i]:
+        # 旧版本的 name_index.json/metainfo.json 迁移到目录数据库
+        migrated = self.catalog.migrate_from_json(self.exists_index_path, self.metainfo_path)
+        if migrated:
+            print(f'Migrated {migrated} entries from {self.exists_index_path}')
+        # 目录先于索引提交 compact，目录的 epoch 较新说明替换特征文件或写出索引时退出，继续完成
+        epoch = self.catalog.get_epoch()
+        if epoch > self.ir_engine.epoch:
+            print(f'Finishing an interrupted compaction (epoch {self.ir_engine.epoch} -> {epoch})')
+            self.ir_engine.recover_compact(epoch)
+        else:
+            self.ir_engine.discard_compact()
+        self.paths.reset(self.catalog.items())
+        # 旧版本只有 HNSW 索引，把已入库的特征补写到特征文件
+        backfilled = self.ir_engine.backfill_store(list(self.paths.snapshot()[1]))
+        if backfilled:
+            print(f'Backfilled {backfilled} features into the feature store')
+
+
+    def diff_catalog(self, files, known):
+        # 与目录中已有的元信息对比，返回新增或大小/修改时间有变化的文件
+        changed = []
+        for fpath, (file_size, file_mtime) in files.items():
+            record = known.get(fpath)
+            if record is None or record[1] != file_size or record[2] != file_mtime:
+                changed.append((fpath, file_size, file_mtime))
+        return changed
+
+
+    def sync_index(self, search_dirs, full=None):
+        """扫描所有索引目录，同时得到新增、修改和删除的文件
+
+        默认为增量扫描，只列举修改时间有变化的目录；full 为真时完整扫描，
+        用于目录修改时间不可靠的文件系统，同时检查不在任何索引目录下的旧记录。
+        删除的文件直接标记，返回需要提取特征的 [(id, path), ...]，
+        包括已记录在目录中、特征却还没写入的文件（上次更新中途退出，或者图片无法解码）。
+        """
+        full = self.full_rescan if full is None else full
+        known_dirs = self.catalog.get_dirs()
+        scan = self.scanner.scan(search_dirs, None if full else known_dirs)
+        # 补上分隔符后做前缀匹配，避免 /a/pic 误匹配 /a/pictures
+        roots = tuple(os.path.join(d, '') for d in search_dirs)
+        failed = tuple(os.path.join(d, '') for d in scan.failed)
+        # 上次记录过、本次没有访问到的目录已被删除；无法访问的目录（例如离线的网络磁盘）保留
+        removed_dirs = []
+        for dir_path in known_dirs:
+            dir_prefix = os.path.join(dir_path, '')
+            if dir_path in scan.dirs or dir_prefix.startswith(failed):
                 continue
-            # 采集元信息
-            file_size = os.path.getsize(exists_index[i])
-            file_mtime = os.path.getmtime(exists_index[i])
-            # 新增元信息
-            if i >= len(metainfo):
-                metainfo.append([file_size, file_mtime])
-                need_index.append(i)
+            if full or dir_prefix.startswith(roots):
+                removed_dirs.append(dir_path)
+        if full:
+            known = self.catalog.snapshot()
+        else:
+            # files.dir 列是 os.path.dirname 的结果，不带末尾分隔符
+            known = self.catalog.snapshot(
+                os.path.dirname(os.path.join(d, '')) for d in scan.listed + removed_dirs)
+        changed = self.diff_catalog(scan.files, known)
+        removed = []
+        outside = []
+        for fpath, (idx, _, _) in known.items():
+            if fpath in scan.files:
                 continue
-            # 检查元信息更新
-            if metainfo[i][0] != file_size or metainfo[i][1] != file_mtime:
-                metainfo[i] = [file_size, file_mtime]
-                need_index.append(i)
-        # 写入索引文件
-        with open(self.exists_index_path, 'wb') as wp:
-            wp.write(json.dumps(exists_index,ensure_ascii=False).encode('UTF-8'))
-        with open(self.metainfo_path, 'wb') as wp:
-            wp.write(json.dumps(metainfo,ensure_ascii=False).encode('UTF-8'))
-        return [(i,exists_index[i]) for i in need_index]
-    
-    def update_ir_index(self, idx, fpath):
-        fv = self.ir_engine.get_fv(fpath)
-        if fv is None:
-            return
-        self.ir_engine.add_fv(fv, idx)
-        self.ir_engine.save_index()
+            if fpath.startswith(roots):
+                if not fpath.startswith(failed):
+                    removed.append(idx)
+            else:
+                outside.append((idx, fpath))
+        # 不在任何索引目录下的旧记录单独检查是否存在
+        if outside:
+            with ThreadPoolExecutor(max_workers=self.scanner.workers) as pool:
+                exists = list(pool.map(os.path.exists, [fpath for _, fpath in outside]))
+            removed.extend(idx for (idx, _), ok in zip(outside, exists) if not ok)
+        if removed:
+            self.catalog.mark_deleted(removed)
+            self.ir_engine.mark_deleted(removed)
+        need_index = self.catalog.upsert(changed)
+        # 删除与新增一次提交，复用的 id 先删后加
+        self.paths.commit(removed, need_index)
+        # 大小和修改时间在提取特征之前就已写入目录，靠特征文件找出没有特征的文件重新排队
+        queued = {idx for idx, _ in need_index}
+        live = self.paths.snapshot()[1]
+        ids = np.fromiter((idx for idx in live if idx not in queued), dtype='int64')
+        unindexed = ids[~self.ir_engine.feature_store.is_valid(ids)]
+        need_index.extend((int(idx), live[int(idx)]) for idx in unindexed)
+        # 文件写入目录之后再记录目录修改时间，中途崩溃时下次仍会重新列举这些目录
+        self.catalog.update_dirs(scan.dirs, removed_dirs)
+        return need_index
 
 
-    def remove_nonexists(self):
-        exists_index = []
-        if os.path.exists(self.exists_index_path):
-            exists_index = json.loads(open(self.exists_index_path, 'rb').read())
-        for idx in tqdm(range(len(exists_index)), ascii=True, desc='删除不存在文件'):
-            if not os.path.exists(exists_index[idx]):
-                exists_index[idx] = NOTEXISTS
-                self.ir_engine.hnsw_index.mark_deleted(idx) # 删除不存在的文件，也就是标记为删除
-                # 容易报错 RuntimeError: The requested to delete element is already deleted
-        with open(self.exists_index_path, 'wb') as wp:
-            wp.write(json.dumps(exists_index,ensure_ascii=False).encode('UTF-8'))
-
-
-    def checkout(self, image_path, exists_index, match_n=5):
-        fv = self.ir_engine.get_fv(image_path)
-        sim, ids = self.ir_engine.match(fv, match_n)
-        return [(sim[i], exists_index[ids[i]]) for i in range(len(ids))]
-
-
-    def get_duplicate(self, exists_index, threshold, same_folder):
-        matched = set()
-        for idx in tqdm(range(len(exists_index)), ascii=True, desc='检索重复图像中'):
-            match_n = 5
-            try:
-                fv = self.ir_engine.hnsw_index.get_items([idx])[0]
-            except RuntimeError:
+    def update(self, search_dirs, full=None):
+        """扫描并更新索引，产出 (已处理数量, 总数)
+
+        先为还没有内容摘要的已入库文件补算摘要，新文件才能与它们按内容匹配并复用特征。
+        整个过程持有维护锁，生成器关闭时释放。
+        """
+        with self.maintenance_lock:
+            need_index = self.sync_index(search_dirs, full)
+            missing = self.missing_hashes(need_index)
+            total = len(missing) + len(need_index)
+            yield 0, total
+            for done in self.backfill_hashes(missing):
+                yield done, total
+            for done in self.update_ir_index(need_index):
+                yield len(missing) + done, total
+
+
+    def count(self):
+        return len(self.paths)
+
+
+    @property
+    def generation(self):
+        return self.paths.generation
+
+
+    def rename(self, old_path, new_path):
+        # 原地更新路径，特征无需重新提取
+        with self.maintenance_lock:
+            idx = self.catalog.get_id(old_path)
+            self.catalog.rename(old_path, new_path)
+            if idx is not None:
+                self.paths.commit(added=[(idx, new_path)])
+
+
+    def rebuild_index(self):
+        count = self.ir_engine.rebuild_index()
+        self.paths.commit()
+        return count
+
+
+    def fit_projection(self, n_components, whiten=False):
+        explained = self.ir_engine.fit_projection(n_components, whiten)
+        self.paths.commit()
+        return explained
+
+
+    def hash_files(self, items):
+        # 读取文件以 IO 为主，用线程池并发计算内容摘要
+        with ThreadPoolExecutor(max_workers=self.scanner.workers) as pool:
+            hashes = list(pool.map(file_hash, [fpath for _, fpath in items]))
+        records = [(idx, h) for (idx, _), h in zip(items, hashes) if h is not None]
+        self.catalog.set_hashes(records)
+        return dict(records)
+
+
+    def missing_hashes(self, need_index=()):
+        """还没有内容摘要的已入库文件 [(id, path), ...]，本次待索引的文件由 update_ir_index 计算，不包括在内"""
+        indexing = {idx for idx, _ in need_index}
+        return [(idx, fpath) for idx, fpath in self.catalog.missing_hashes() if idx not in indexing]
+
+
+    def backfill_hashes(self, items, batch_size=4096):
+        """为旧版本建立的索引补算内容摘要，分批写入目录，产出累计处理的数量"""
+        for start in range(0, len(items), batch_size):
+            self.hash_files(items[start:start+batch_size])
+            yield min(start + batch_size, len(items))
+
+
+    def copy_fvs(self, pairs):
+        # 内容相同的文件直接复用已有特征，返回无法复用的目标 id
+        dst_ids = []
+        fvs = []
+        failed = []
+        for dst, src in pairs:
+            fv = self.ir_engine.get_fv_by_id(src)
+            if fv is None:
+                failed.append(dst)
                 continue
-            sim, ids = self.ir_engine.match(fv, match_n)
-            while sim[-1] > threshold:
-                match_n = round(match_n*1.5)
-                sim, ids = self.ir_engine.match(fv, match_n)
-            for i in range(len(ids)):
-                if ids[i] == idx:
-                    continue
-                if sim[i] < threshold:
-                    continue
-                if ids[i] in matched:
-                    continue
-                if not idx in matched:
-                    matched.add(idx)
-                path_a = exists_index[idx]
-                path_b = exists_index[ids[i]]
+            dst_ids.append(dst)
+            fvs.append(fv)
+        if dst_ids:
+            self.ir_engine.add_fv(np.stack(fvs), dst_ids)
+            self.catalog.touch(dst_ids)
+            self.paths.commit()
+        return failed
+
+
+    def update_ir_index(self, need_index, batch_size=None):
+        # 先计算内容摘要，与已入库文件内容相同的直接复用特征，不再解码和推理
+        hashes = self.hash_files(need_index)
+        existing = self.catalog.find_by_hash(set(hashes.values()), exclude=[idx for idx, _ in need_index])
+        to_infer = []
+        reuse_existing = []
+        reuse_batch = []
+        first = {}
+        for idx, fpath in need_index:
+            h = hashes.get(idx)
+            if h in existing:
+                reuse_existing.append((idx, existing[h]))
+            elif h in first:
+                # 本批次内的重复文件等第一份提取完特征后再复用
+                reuse_batch.append((idx, first[h]))
+            else:
+                if h is not None:
+                    first[h] = idx
+                to_infer.append((idx, fpath))
+        # 一次扩容到足够容纳本次全部文件，避免逐批扩容
+        self.ir_engine.reserve(self.ir_engine.hnsw_index.get_current_count() + len(need_index))
+        paths = dict(need_index)
+        to_infer.extend((idx, paths[idx]) for idx in self.copy_fvs(reuse_existing))
+        reused = len(need_index) - len(to_infer) - len(reuse_batch)
+        if reused:
+            yield reused
+        # 解码与推理并行的流水线按批写入索引，每完成一批产出已处理的文件数量，便于调用方更新进度
+        pipeline = IndexPipeline(
+            self.ir_engine,
+            batch_size or self.index_batch_size,
+            self.decode_workers,
+            self.prefetch_batches,
+        )
+        for ids, fvs, done in pipeline.run(to_infer):
+            if ids:
+                # 特征先追加到增量日志，满足阈值时才完整写出索引文件
+                self.ir_engine.add_fv(fvs, ids)
+                self.catalog.touch(ids)
+                self.ir_engine.maybe_compact()
+                # 路径不变，但这些 id 的特征变了，更换代号
+                self.paths.commit()
+            yield reused + done
+        # 第一份损坏时副本同样无法解码，直接跳过
+        self.copy_fvs(reuse_batch)
+        self.ir_engine.maybe_compact()
+        if to_infer:
+            print(f'\nIndexing: {pipeline.report()}')
+        if need_index:
+            print(f'Reused features for {len(need_index) - len(to_infer)} identical files')
+            yield len(need_index)
+
+
+    def remove_nonexists(self):
+        with self.maintenance_lock:
+            items = list(self.paths.snapshot()[1].items())
+            # 网络磁盘上逐个 stat 延迟很高，用线程池并发检查
+            with ThreadPoolExecutor(max_workers=self.scanner.workers) as pool:
+                exists = list(tqdm(pool.map(os.path.exists, [fpath for _, fpath in items]),
+                                   total=len(items), ascii=True, desc='删除不存在文件'))
+            removed = [idx for (idx, _), ok in zip(items, exists) if not ok]
+            # 删除不存在的文件，也就是标记为删除，删除记录同样写入增量日志
+            if removed:
+                self.catalog.mark_deleted(removed)
+                self.ir_engine.mark_deleted(removed)
+                self.paths.commit(removed)
+
+
+    def compact(self, force=False):
+        """墓碑比例超过阈值（或 force 为真）时，把目录、特征文件和 HNSW 索引重建为连续的 id
+
+        新 id 与原 id 的顺序一致。查重的中间结果以 id 为键，重建后作废。
+
+        Returns:
+            dict: 墓碑数量、比例，以及重建前后估算的内存占用（字节）
+        """
+        # live_ids 取自持有维护锁时的目录，重新编号完成前不会有新文件写入
+        with self.maintenance_lock:
+            return self._compact(force)
+
+
+    def _compact(self, force):
+        tombstones = self.catalog.tombstone_count()
+        live_ids = [idx for idx, _ in self.catalog.items()]
+        fraction = tombstones / max(tombstones + len(live_ids), 1)
+        report = {'tombstones': tombstones, 'live': len(live_ids), 'fraction': fraction, 'compacted': False}
+        if not tombstones or (not force and fraction < self.compact_tombstone_fraction):
+            return report
+        index_before, store_before = self.ir_engine.nbytes()
+        # 先把增量日志合并进索引文件，中途退出后重启时不会把旧 id 的记录重放到重新编号的特征上
+        self.ir_engine.save_index()
+        prepared = self.ir_engine.prepare_compact(live_ids)
+        # 目录与索引先后记录同一个 epoch，之间任何一步失败，下次启动时 check_env 都能发现并完成替换
+        epoch = self.ir_engine.epoch + 1
+        # 持有写锁直到路径视图也换成新编号，查询不会在新旧编号之间读到 id 与路径
+        with self.ir_engine.lock.write():
+            self.catalog.compact(live_ids, epoch)
+            self.ir_engine.finish_compact(prepared, epoch)
+            self.paths.reset(self.catalog.items())
+        if os.path.exists(self.dedup_state_path):
+            os.remove(self.dedup_state_path)
+        index_after, store_after = self.ir_engine.nbytes()
+        report.update({
+            'compacted': True,
+            'index_bytes': (index_before, index_after),
+            'store_bytes': (store_before, store_after),
+            'reclaimed_bytes': index_before + store_before - index_after - store_after,
+        })
+        return report
+
+
+    def stats(self):
+        return {
+            'batching': self.batcher.stats(),
+            'feature_cache': self.feature_cache.stats(),
+            'result_cache': self.result_cache.stats(),
+        }
+
+
+    def close(self):
+        # 退出前把增量日志合并进索引文件
+        self.batcher.close()
+        self.ir_engine.close()
+        self.catalog.close()
+
+
+    def checkout(self, image_path, match_n=5, ef=None, backend=None, roots=None, digest=None):
+        if match_n <= 0:
+            return []
+        # 调用方已算好摘要时直接使用，不再重复读取图片
+        digest = digest or image_hash(image_path)
+        if digest is None:
+            return []
+        # 先取代号再查询，查询期间索引有变化时结果记在旧代号下，之后的查询不会命中
+        key = (digest, match_n, ef, backend, tuple(roots or ()), self.paths.generation)
+        results = self.result_cache.get(key)
+        if results is not None:
+            return list(results)
+        fv = self.feature_cache.get(digest)
+        while True:
+            # 查询在批处理线程中执行，取路径时已不持有读锁；期间 compact 重新编号时用同一特征重新查询
+            epoch = self.ir_engine.epoch
+            result = self.batcher.query(image_path, match_n, ef, backend, fv)
+            if result is None:
+                return []
+            ids, distances, fv = result
+            paths = self.paths.get_paths(ids)
+            if self.ir_engine.epoch == epoch:
+                break
+        self.feature_cache.put(digest, fv)
+        sim = self.ir_engine.similarity(distances)
+        results = [(sim[i], paths[i]) for i in range(len(ids)) if paths[i] is not None]
+        if roots:
+            # 单一索引只能在查询后按目录过滤，结果可能少于 match_n；需要按目录查询时使用分片索引
+            prefixes = tuple(os.path.join(os.path.normpath(r), '') for r in roots)
+            results = [(s, p) for s, p in results if os.path.normpath(p).startswith(prefixes)]
+        self.result_cache.put(key, results)
+        return list(results)
+
+
+    def get_exact_duplicate(self, same_folder):
+        # 内容摘要相同的文件直接从目录查出，不需要任何近邻检索
+        for group in self.catalog.hash_groups():
+            idx_a, path_a = group[0]
+            for idx_b, path_b in group[1:]:
                 if same_folder:
                     if os.path.dirname(path_a) != os.path.dirname(path_b):
                         continue
-                yield (path_a, path_b, sim[i])
+                yield (idx_a, idx_b, path_a, path_b)
+
+
+    def get_duplicate(self, threshold, same_folder):
+        # 先立即给出内容完全相同的文件，再用近邻检索查找相似图片
+        exact_pairs = set()
+        for idx_a, idx_b, path_a, path_b in self.get_exact_duplicate(same_folder):
+            exact_pairs.add((idx_a, idx_b))
+            yield (path_a, path_b, 100.0)
+        exists_index = self.paths.snapshot()[1]
+        yield from self.dedup_engine.find_pairs(exists_index, threshold, same_folder, exact_pairs)
+
+
+    def get_duplicate_groups(self, threshold, same_folder, incremental=False):
+        """把重复图片合并为组，每组包含代表图片以及其余成员与代表的相似度
+
+        incremental 为真且上次查重的参数相同时，只查询上次之后新增或修改的文件，
+        并与保存的结果合并。
+        """
+        exists_index = self.paths.snapshot()[1]
+        exact_groups = []
+        for group in self.catalog.hash_groups():
+            if same_folder:
+                # 同目录模式下按目录拆分内容相同的文件
+                by_dir = {}
+                for idx, path in group:
+                    by_dir.setdefault(os.path.dirname(path), []).append(idx)
+                exact_groups.extend(ids for ids in by_dir.values() if len(ids) > 1)
+            else:
+                exact_groups.append([idx for idx, _ in group])
+        # 在查询之前取水位；此后才写入特征的文件序号会更大，下次增量查重时查询
+        high_water = self.catalog.max_seq()
+        state = self.dedup_engine.load_state(self.dedup_state_path) if incremental else None
+        if state is not None and state['threshold'] == threshold and state['same_folder'] == same_folder:
+            changed_ids = self.catalog.ids_since(state['high_water'])
+            edges = self.dedup_engine.update_edges(state, exists_index, changed_ids, threshold, same_folder)
+        else:
+            edges = self.dedup_engine.find_edges(exists_index, list(exists_index), threshold, same_folder)
+        self.dedup_engine.save_state(self.dedup_state_path, edges, high_water, threshold, same_folder)
+        return self.dedup_engine.find_groups(exists_index, threshold, same_folder, exact_groups, edges)